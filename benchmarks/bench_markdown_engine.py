@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__copyright__ = "Copyright (C) 2014 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+__doc__ = """
+Measures the per-call cost of Markdown engine setup in markup rendering.
+Compares building a fresh engine for every call (as markup_to_html used to
+do) with reusing a pooled engine that is reset between uses.
+
+Run from the root of the CourseFlow checkout::
+
+    python benchmarks/bench_markdown_engine.py
+"""
+
+import sys
+from os.path import dirname, abspath
+from timeit import default_timer
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from django.conf import settings  # noqa
+settings.configure(
+        CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                }
+            })
+
+SAMPLE_TEXT = u"""
+# Homework 3
+
+Please solve the following problems. Recall that $e^{i\\pi} = -1$.
+
+| Problem | Points |
+|---------|--------|
+| 1       | 5      |
+| 2       | 10     |
+
+    :::python
+    def f(x):
+        return x**2
+"""
+
+
+def time_per_call(f, count):
+    start = default_timer()
+    for i in range(count):
+        f()
+    return (default_timer() - start) / count
+
+
+def main():
+    from course.content import make_markdown_engine
+
+    count = 200
+
+    def fresh_setup():
+        make_markdown_engine()
+
+    md, link_fixer = make_markdown_engine()
+
+    def pooled_setup():
+        link_fixer.set_context(None, None)
+        md.reset()
+
+    def fresh_render():
+        md, link_fixer = make_markdown_engine()
+        md.convert(SAMPLE_TEXT)
+
+    def pooled_render():
+        link_fixer.set_context(None, None)
+        md.reset()
+        md.convert(SAMPLE_TEXT)
+
+    for name, f in [
+            ("setup, fresh engine", fresh_setup),
+            ("setup, pooled engine", pooled_setup),
+            ("setup+render, fresh engine", fresh_render),
+            ("setup+render, pooled engine", pooled_render),
+            ]:
+        print("%-30s %10.1f us/call" % (name, 1e6*time_per_call(f, count)))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: foldmethod=marker
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__copyright__ = "Copyright (C) 2014 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+__doc__ = """
+Measures the latency of starting a flow session (creating the session and
+its page data) as a function of the number of pages in the flow. Compares
+writing one row per page (as start_flow used to do) with the bulk insert
+done by set_up_flow_session_page_data.
+
+Runs against a freshly created test database. Run from the root of the
+CourseFlow checkout::
+
+    python benchmarks/bench_start_flow.py
+"""
+
+import os
+import sys
+from os.path import dirname, abspath
+from timeit import default_timer
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "courseflow.settings")
+
+
+def make_flow_desc(page_count):
+    from courseflow.utils import dict_to_struct
+    return dict_to_struct({
+        "groups": [{
+            "id": "main",
+            "pages": [{
+                "type": "ChoiceQuestion",
+                "id": "q%d" % i,
+                "value": 1,
+                "title": "Question %d" % i,
+                "prompt": "Pick one.",
+                "choices": ["~CORRECT~ A", "B", "C", "D"],
+                "shuffle": True,
+                } for i in range(page_count)]
+            }]
+        })
+
+
+def start_session_per_row(course, flow_desc):
+    from course.models import FlowSession, FlowPageData
+    from course.content import get_flow_page
+
+    session = FlowSession(course=course, flow_id="bench",
+            active_git_commit_sha="0"*40, in_progress=True, for_credit=True)
+    session.save()
+
+    ordinal = 0
+    for grp in flow_desc.groups:
+        for page_desc in grp.pages:
+            data = FlowPageData()
+            data.flow_session = session
+            data.ordinal = ordinal
+            data.group_id = grp.id
+            data.page_id = page_desc.id
+            data.data = get_flow_page(None, course.identifier, "bench",
+                    flow_desc, grp.id, page_desc.id, "0"*40).make_page_data()
+            data.save()
+
+            ordinal += 1
+
+    session.page_count = ordinal
+    session.save()
+
+
+def start_session_bulk(course, flow_desc):
+    from course.models import FlowSession
+    from course.content import set_up_flow_session_page_data
+
+    session = FlowSession(course=course, flow_id="bench",
+            active_git_commit_sha="0"*40, in_progress=True, for_credit=True)
+    set_up_flow_session_page_data(None, session, course.identifier,
+            flow_desc, "0"*40)
+
+
+def time_per_call(f, count):
+    from django.db import transaction
+
+    start = default_timer()
+    for i in range(count):
+        with transaction.atomic():
+            f()
+    return (default_timer() - start) / count
+
+
+def main():
+    import django
+    django.setup()
+
+    from django.test.utils import setup_test_environment
+    from django.db import connection
+    setup_test_environment()
+    old_db_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+
+    try:
+        from course.models import Course
+        course = Course.objects.create(identifier="bench",
+                email="bench@example.com", active_git_commit_sha="0"*40)
+
+        count = 20
+
+        print("%6s %15s %15s" % ("pages", "per-row [ms]", "bulk [ms]"))
+        for page_count in [1, 10, 50, 150, 500]:
+            flow_desc = make_flow_desc(page_count)
+
+            per_row = time_per_call(
+                    lambda: start_session_per_row(course, flow_desc), count)
+            bulk = time_per_call(
+                    lambda: start_session_bulk(course, flow_desc), count)
+
+            print("%6d %15.2f %15.2f" % (page_count, 1e3*per_row, 1e3*bulk))
+
+    finally:
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: foldmethod=marker
@@ -31,7 +31,7 @@ from course.models import (
         FlowSession, FlowPageData,
         FlowPageVisit, FlowPageVisitGrade,
         FlowAccessException, FlowAccessExceptionEntry,
-        GradingOpportunity, GradeChange, InstantMessage)
+        GradingOpportunity, GradeChange, GradingJob, InstantMessage)
 from django import forms
 from course.enrollment import (approve_enrollment, deny_enrollment)
 
@@ -182,6 +182,22 @@ class FlowPageDataInline(admin.TabularInline):
     extra = 0
 
 
+def regrade_flow_sessions(modeladmin, request, queryset):
+    from course.grading import enqueue_regrade
+    from django.contrib import messages
+
+    try:
+        jobs = enqueue_regrade(queryset)
+    except ValueError as e:
+        messages.add_message(request, messages.ERROR, str(e))
+        return
+
+    messages.add_message(request, messages.INFO,
+            "%d grading jobs queued." % len(jobs))
+
+regrade_flow_sessions.short_description = "Regrade (in the grading queue)"
+
+
 class FlowSessionAdmin(admin.ModelAdmin):
     def get_participant(self, obj):
         if obj.participation is None:
@@ -229,6 +245,8 @@ class FlowSessionAdmin(admin.ModelAdmin):
 
     save_on_top = True
 
+    actions = [regrade_flow_sessions]
+
 admin.site.register(FlowSession, FlowSessionAdmin)
 
 # }}}
@@ -426,6 +444,39 @@ class GradeChangeAdmin(admin.ModelAdmin):
 
 admin.site.register(GradeChange, GradeChangeAdmin)
 
+
+def requeue_grading_jobs(modeladmin, request, queryset):
+    from course.grading import requeue_failed_grading_jobs
+    count = requeue_failed_grading_jobs(queryset)
+
+    from django.contrib import messages
+    messages.add_message(request, messages.INFO,
+            "%d failed jobs requeued." % count)
+
+requeue_grading_jobs.short_description = "Requeue failed jobs"
+
+
+class GradingJobAdmin(admin.ModelAdmin):
+    list_display = (
+            "id",
+            "visit",
+            "state",
+            "priority",
+            "attempts",
+            "worker",
+            "creation_time",
+            "start_time",
+            "completion_time",
+            )
+    list_filter = ("state", "priority")
+    date_hierarchy = "creation_time"
+
+    raw_id_fields = ("flow_session", "visit")
+
+    actions = [requeue_grading_jobs]
+
+admin.site.register(GradingJob, GradingJobAdmin)
+
 # }}}
 
 
@@ -255,12 +255,9 @@ def make_page_answer_stats_list(pctx, flow_identifier):
                         visit.flow_session)
                 page = page_cache.get_page(group_desc.id, page_desc.id,
                         flow_commit_sha)
-
-                from course.page import PageContext
-                grading_page_context = PageContext(
-                        course=pctx.course,
-                        repo=pctx.repo,
-                        commit_sha=flow_commit_sha)
+                grading_page_context = (
+                        page_cache.get_grading_context(flow_commit_sha)
+                        .page_context)
 
                 title = page.title(grading_page_context, visit.page_data.data)
 
@@ -372,12 +369,9 @@ def page_analytics(pctx, flow_identifier, group_id, page_id):
                 pctx.course, pctx.participation, flow_desc,
                 visit.flow_session)
         page = page_cache.get_page(group_id, page_id, flow_commit_sha)
-
-        from course.page import PageContext
-        grading_page_context = PageContext(
-                course=pctx.course,
-                repo=pctx.repo,
-                commit_sha=flow_commit_sha)
+        grading_page_context = (
+                page_cache.get_grading_context(flow_commit_sha)
+                .page_context)
 
         title = page.title(grading_page_context, visit.page_data.data)
         body = page.body(grading_page_context, visit.page_data.data)
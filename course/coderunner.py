@@ -0,0 +1,673 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2014 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+__doc__ = """
+Backends that run the code submitted for
+:class:`course.page.PythonCodeQuestion`. Each takes a run request as
+described in :mod:`cfrunpy_backend` and returns the response as a
+:class:`dict`. The backend is chosen by the
+``CF_CODE_RUNNER`` setting:
+
+* ``"docker"`` (the default) runs each request in a cfrunpy container.
+  Containers run cfrunpy in fork-server mode, so that each request is
+  served by a forked child that starts in an empty directory and is killed,
+  along with anything it started, once it is done. With a container pool
+  (``CF_DOCKER_POOL_SIZE``), containers are therefore reused for up to
+  ``CF_DOCKER_POOL_MAX_CONTAINER_USES`` requests. Without one, each
+  request gets a fresh container.
+* ``"local"`` runs each request in a resource-limited subprocess on the
+  same host. This needs no Docker daemon, but it provides no isolation
+  beyond that of the server's user account, and is only meant for trusted
+  code, e.g. in development.
+"""
+
+import threading
+
+
+CFRUNPY_PORT = 9941
+DOCKER_TIMEOUT = 15
+
+
+class InvalidPingResponse(RuntimeError):
+    pass
+
+
+class ContainerStartTimeout(RuntimeError):
+    pass
+
+
+# {{{ cfrunpy container lifecycle
+
+def make_docker_client():
+    import docker
+    return docker.Client(
+            base_url='unix://var/run/docker.sock',
+            version='1.12', timeout=DOCKER_TIMEOUT)
+
+
+class CfrunpyContainer(object):
+    def __init__(self, container_id, port):
+        from time import time
+
+        self.container_id = container_id
+        self.port = port
+        self.start_time = time()
+        self.last_use_time = self.start_time
+        self.last_health_check_time = self.start_time
+        self.use_count = 0
+
+
+def ping_cfrunpy(port, timeout=None):
+    """
+    :returns: *True* if the cfrunpy server on *port* responds.
+    """
+    import httplib
+    import socket
+    from httplib import BadStatusLine
+
+    try:
+        connection = httplib.HTTPConnection('localhost', port, timeout=timeout)
+
+        connection.request('GET', '/ping')
+
+        response = connection.getresponse()
+        response_data = response.read().decode("utf-8")
+
+        if response_data != b"OK":
+            raise InvalidPingResponse()
+
+        return True
+
+    except (socket.error, BadStatusLine, InvalidPingResponse):
+        return False
+
+
+def start_cfrunpy_container(docker_cnx):
+    """Create and start a container running cfrunpy, and wait until it
+    responds.
+
+    :raises: :exc:`ContainerStartTimeout`
+    """
+
+    from django.conf import settings
+
+    command = [
+            "/opt/cfrunpy/cfrunpy-venv/bin/python",
+            "/opt/cfrunpy/cfrunpy",
+            "--fork-server"]
+
+    preload = getattr(settings, "CF_DOCKER_CFRUNPY_PRELOAD", [])
+    if preload:
+        # Imported while the container waits in the pool, rather than by
+        # each run's setup code.
+        command.extend(["--preload", ",".join(preload)])
+
+    dresult = docker_cnx.create_container(
+            image=settings.CF_DOCKER_CFRUNPY_IMAGE,
+            command=command,
+            mem_limit=256e6,
+            user="cfrunpy")
+
+    container_id = dresult["Id"]
+
+    try:
+        # FIXME: Prohibit networking
+
+        docker_cnx.start(
+                container_id,
+                port_bindings={CFRUNPY_PORT: ('127.0.0.1',)})
+
+        port_info, = docker_cnx.port(container_id, CFRUNPY_PORT)
+        port = int(port_info["HostPort"])
+
+        from time import time, sleep
+        start_time = time()
+
+        # {{{ ping until response received
+
+        while not ping_cfrunpy(port):
+            if time() - start_time < DOCKER_TIMEOUT:
+                sleep(0.1)
+                # and retry
+            else:
+                raise ContainerStartTimeout()
+
+        # }}}
+
+    except:
+        remove_cfrunpy_container(docker_cnx, container_id)
+        raise
+
+    return CfrunpyContainer(container_id, port)
+
+
+def remove_cfrunpy_container(docker_cnx, container_id):
+    from docker.errors import APIError as DockerAPIError
+
+    try:
+        docker_cnx.stop(container_id, timeout=3)
+    except DockerAPIError:
+        # That's OK--the container might have stopped on its
+        # own already.
+        pass
+
+    docker_cnx.remove_container(container_id)
+
+# }}}
+
+
+# {{{ warm container pool
+
+class CfrunpyContainerPool(object):
+    """Keeps a number of started cfrunpy containers ready for use. A
+    container serves one run request (or batch) at a time. After serving
+    *max_uses* of them, or one that did not complete normally, it is
+    removed. Containers are started, health-checked and removed by a
+    background thread.
+    """
+
+    def __init__(self, size, max_idle_time, health_check_interval,
+            max_uses=1):
+        self.size = size
+        self.max_idle_time = max_idle_time
+        self.health_check_interval = health_check_interval
+        self.max_uses = max_uses
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+        # oldest first
+        self.ready = []
+        self.retired = []
+
+        # Containers handed out by get() count towards the pool's size, as
+        # they may come back for reuse.
+        self.in_use = 0
+
+        maintainer = threading.Thread(
+                target=self._maintain, name="cfrunpy-container-pool")
+        maintainer.daemon = True
+        maintainer.start()
+
+        import atexit
+        atexit.register(self.shut_down)
+
+    def get(self, docker_cnx):
+        """Return a :class:`CfrunpyContainer` that is ready to serve a run
+        request. If no pooled container is available, one is started.
+        """
+
+        from time import time
+
+        while True:
+            with self.lock:
+                container = None
+                if self.ready:
+                    container = self.ready.pop()
+
+                self.wakeup.notify()
+
+            if container is None:
+                container = start_cfrunpy_container(docker_cnx)
+            elif not (time() - container.last_health_check_time
+                    < self.health_check_interval
+                    or ping_cfrunpy(container.port, timeout=1)):
+                with self.lock:
+                    self.retired.append(container)
+                continue
+
+            with self.lock:
+                self.in_use += 1
+
+            return container
+
+    def release(self, container):
+        """Return *container* after it has served a run request that
+        completed normally. It is kept for reuse unless it has been used
+        up or the pool is full.
+        """
+
+        from time import time
+
+        container.use_count += 1
+        container.last_use_time = container.last_health_check_time = time()
+
+        with self.lock:
+            self.in_use -= 1
+
+            if (container.use_count < self.max_uses
+                    and len(self.ready) < self.size):
+                self.ready.append(container)
+            else:
+                self.retired.append(container)
+
+            self.wakeup.notify()
+
+    def retire(self, container):
+        """Arrange for a container obtained from :meth:`get` to be removed
+        rather than reused.
+        """
+
+        with self.lock:
+            self.in_use -= 1
+            self.retired.append(container)
+            self.wakeup.notify()
+
+    def _maintain(self):
+        from time import time, sleep
+
+        docker_cnx = make_docker_client()
+
+        while True:
+            with self.lock:
+                now = time()
+
+                idle = [
+                        container for container in self.ready
+                        if now - container.last_use_time > self.max_idle_time]
+                for container in idle:
+                    self.ready.remove(container)
+
+                retired = self.retired + idle
+                self.retired = []
+
+                need_container = len(self.ready) + self.in_use < self.size
+
+                to_check = [
+                        container for container in self.ready
+                        if now - container.last_health_check_time
+                        >= self.health_check_interval]
+
+                if not (retired or need_container or to_check):
+                    self.wakeup.wait(self.health_check_interval)
+                    continue
+
+            for container in retired:
+                try:
+                    remove_cfrunpy_container(docker_cnx, container.container_id)
+                except Exception:
+                    pass
+
+            for container in to_check:
+                if ping_cfrunpy(container.port, timeout=1):
+                    container.last_health_check_time = time()
+                else:
+                    with self.lock:
+                        if container in self.ready:
+                            self.ready.remove(container)
+                            self.retired.append(container)
+
+            if need_container:
+                try:
+                    container = start_cfrunpy_container(docker_cnx)
+                except Exception:
+                    # Docker trouble. Back off before trying again.
+                    sleep(5)
+                else:
+                    with self.lock:
+                        self.ready.append(container)
+
+    def shut_down(self):
+        with self.lock:
+            containers = self.ready + self.retired
+            self.ready = []
+            self.retired = []
+            self.size = 0
+
+        docker_cnx = make_docker_client()
+        for container in containers:
+            try:
+                remove_cfrunpy_container(docker_cnx, container.container_id)
+            except Exception:
+                pass
+
+
+_CONTAINER_POOL = None
+_CONTAINER_POOL_LOCK = threading.Lock()
+
+
+def get_cfrunpy_container_pool():
+    """
+    :returns: the process-wide :class:`CfrunpyContainerPool`, or *None* if
+        pooling is disabled (``CF_DOCKER_POOL_SIZE`` is 0).
+    """
+
+    global _CONTAINER_POOL
+
+    from django.conf import settings
+
+    size = getattr(settings, "CF_DOCKER_POOL_SIZE", 0)
+    if not size:
+        return None
+
+    with _CONTAINER_POOL_LOCK:
+        if _CONTAINER_POOL is None:
+            _CONTAINER_POOL = CfrunpyContainerPool(
+                    size=size,
+                    max_idle_time=getattr(
+                        settings, "CF_DOCKER_POOL_MAX_IDLE_TIME", 600),
+                    health_check_interval=getattr(
+                        settings, "CF_DOCKER_POOL_HEALTH_CHECK_INTERVAL", 30),
+                    max_uses=getattr(
+                        settings, "CF_DOCKER_POOL_MAX_CONTAINER_USES", 50))
+
+    return _CONTAINER_POOL
+
+# }}}
+
+
+# {{{ backends
+
+class CodeRunnerBackend(object):
+    def run(self, run_req, run_timeout):
+        """
+        :arg run_req: a :class:`dict` with the run request.
+        :arg run_timeout: time limit for the run, in seconds.
+        :returns: a :class:`dict` with the response.
+        """
+        raise NotImplementedError()
+
+    def run_batch(self, common, run_reqs, run_timeout):
+        """Run many requests that share the entries in *common* (e.g. the
+        ``setup_code`` and ``test_code`` of one question).
+
+        :returns: an iterable of tuples ``(index, response)``, where *index*
+            refers to *run_reqs*, in no particular order.
+        """
+
+        for index, req in enumerate(run_reqs):
+            full_req = common.copy()
+            full_req.update(req)
+            yield index, self.run(full_req, run_timeout)
+
+
+class DockerCodeRunnerBackend(CodeRunnerBackend):
+    def _get_container(self, docker_cnx, pool):
+        if pool is not None:
+            return pool.get(docker_cnx)
+        else:
+            return start_cfrunpy_container(docker_cnx)
+
+    def _release_container(self, docker_cnx, pool, container, reusable):
+        """
+        :arg reusable: whether the request completed normally, so that
+            *container* may serve further requests.
+        """
+        if pool is None:
+            remove_cfrunpy_container(docker_cnx, container.container_id)
+        elif reusable:
+            pool.release(container)
+        else:
+            pool.retire(container)
+
+    def run(self, run_req, run_timeout):
+        import json
+        import httplib
+        import socket
+
+        docker_cnx = make_docker_client()
+        pool = get_cfrunpy_container_pool()
+
+        try:
+            container = self._get_container(docker_cnx, pool)
+        except ContainerStartTimeout:
+            from traceback import format_exc
+            return {
+                    "result": "uncaught_error",
+                    "message": "Timeout waiting for container.",
+                    "traceback": "".join(format_exc()),
+                    }
+
+        reusable = False
+        try:
+            try:
+                # Add a second to accommodate 'wire' delays
+                connection = httplib.HTTPConnection(
+                        'localhost', container.port,
+                        timeout=1 + run_timeout)
+
+                # cfrunpy kills the run if it takes longer than this.
+                headers = {
+                        'Content-type': 'application/json',
+                        'X-Run-Timeout': str(run_timeout),
+                        }
+
+                json_run_req = json.dumps(run_req).encode("utf-8")
+
+                connection.request(
+                        'POST', '/run-python', json_run_req, headers)
+
+                http_response = connection.getresponse()
+                response_data = http_response.read().decode("utf-8")
+                response = json.loads(response_data)
+                reusable = http_response.status == 200
+                return response
+
+            except socket.timeout:
+                return {"result": "timeout"}
+
+        finally:
+            self._release_container(docker_cnx, pool, container, reusable)
+
+    def run_batch(self, common, run_reqs, run_timeout):
+        """Run the whole batch in one container, using cfrunpy's
+        ``/run-batch`` endpoint, and yield responses as they arrive.
+        """
+
+        import json
+        import httplib
+
+        docker_cnx = make_docker_client()
+        pool = get_cfrunpy_container_pool()
+
+        container = self._get_container(docker_cnx, pool)
+
+        reusable = False
+        try:
+            # Runs are killed after run_timeout, so some result arrives at
+            # least that often.
+            connection = httplib.HTTPConnection('localhost', container.port,
+                    timeout=5 + run_timeout)
+
+            headers = {'Content-type': 'application/json'}
+
+            json_batch = json.dumps({
+                "common": common,
+                "requests": run_reqs,
+                "run_timeout": run_timeout,
+                }).encode("utf-8")
+
+            connection.request('POST', '/run-batch', json_batch, headers)
+
+            http_response = connection.getresponse()
+            if http_response.status != 200:
+                response_data = http_response.read().decode("utf-8")
+                raise RuntimeError("batch run failed: %s" % response_data)
+
+            # cfrunpy answers in HTTP/1.0 without a content length, so the
+            # body is everything up to the end of the connection.
+            for line in iter(http_response.fp.readline, b""):
+                line = line.strip()
+                if line:
+                    result = json.loads(line.decode("utf-8"))
+                    yield result["index"], result["response"]
+
+            reusable = True
+
+        finally:
+            self._release_container(docker_cnx, pool, container, reusable)
+
+
+class LocalCodeRunnerBackend(CodeRunnerBackend):
+    """Runs ``cfrunpy --stdin`` in a subprocess for each request, with
+    limits on CPU time, address space and written file size. The subprocess
+    gets a minimal environment and runs in an empty temporary directory,
+    but it can still do anything the server's user account can do. Only
+    use this for trusted code, e.g. in development.
+    """
+
+    def __init__(self, python, memory_limit, file_size_limit):
+        # Resolve the interpreter (which may be a wrapper script that needs
+        # the server's environment) to its actual executable, since runs
+        # do not get the server's environment.
+        import subprocess
+        self.python = subprocess.check_output(
+                [python, "-c", "import sys; print(sys.executable)"]
+                ).decode("utf-8").strip()
+        self.memory_limit = memory_limit
+        self.file_size_limit = file_size_limit
+
+    def run(self, run_req, run_timeout):
+        import os
+        import math
+        import shutil
+        import subprocess
+        from os.path import dirname, join
+        from tempfile import mkdtemp
+
+        cfrunpy_dir = join(dirname(dirname(os.path.abspath(__file__))),
+                "cfrunpy")
+
+        # cfrunpy applies the limits itself, rather than a preexec_fn, which
+        # is not safe to use in a threaded server. It also starts a session
+        # of its own, so that everything the submitted code starts can be
+        # killed along with it.
+        cpu_limit = int(math.ceil(run_timeout)) + 1
+
+        work_dir = mkdtemp(prefix="cfrunpy-")
+        try:
+            # Keep the server's environment (which may hold secrets) and its
+            # working directory out of reach of the submitted code.
+            proc = subprocess.Popen(
+                    [self.python, "-E", "-s",
+                        join(cfrunpy_dir, "cfrunpy"), "--stdin",
+                        "--new-session",
+                        "--cpu-limit", str(cpu_limit),
+                        "--memory-limit", str(self.memory_limit),
+                        "--file-size-limit", str(self.file_size_limit)],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    cwd=work_dir, close_fds=True,
+                    env={
+                        "PATH": "/usr/local/bin:/usr/bin:/bin",
+                        "LANG": "C.UTF-8",
+                        "HOME": work_dir,
+                        })
+
+            try:
+                return self._communicate(proc, run_req, run_timeout)
+            finally:
+                # Processes left behind by the submitted code
+                self._kill_process_group(proc)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _kill_process_group(self, proc):
+        import os
+        import signal
+
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            # The session has not been started yet, or is gone already.
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def _communicate(self, proc, run_req, run_timeout):
+        import json
+
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            self._kill_process_group(proc)
+
+        # Add a second to accommodate interpreter startup
+        timer = threading.Timer(1 + run_timeout, kill)
+        timer.start()
+        try:
+            stdout_data, stderr_data = proc.communicate(
+                    json.dumps(run_req).encode("utf-8"))
+        finally:
+            timer.cancel()
+
+        if timed_out:
+            return {"result": "timeout"}
+
+        try:
+            return json.loads(stdout_data.decode("utf-8"))
+        except ValueError:
+            import signal
+            if -proc.returncode == getattr(signal, "SIGXCPU", None):
+                return {"result": "timeout"}
+
+            return {
+                    "result": "uncaught_error",
+                    "message": "Code runner exited with status %d."
+                    % proc.returncode,
+                    "traceback": stderr_data.decode("utf-8", "replace"),
+                    }
+
+
+_CODE_RUNNER = None
+_CODE_RUNNER_LOCK = threading.Lock()
+
+
+def get_code_runner():
+    """
+    :returns: the process-wide :class:`CodeRunnerBackend` selected by the
+        ``CF_CODE_RUNNER`` setting.
+    """
+
+    global _CODE_RUNNER
+
+    from django.conf import settings
+
+    with _CODE_RUNNER_LOCK:
+        if _CODE_RUNNER is None:
+            kind = getattr(settings, "CF_CODE_RUNNER", "docker")
+
+            if kind == "docker":
+                _CODE_RUNNER = DockerCodeRunnerBackend()
+            elif kind == "local":
+                _CODE_RUNNER = LocalCodeRunnerBackend(
+                        python=getattr(
+                            settings, "CF_LOCAL_RUNNER_PYTHON", "python3"),
+                        memory_limit=int(getattr(
+                            settings, "CF_LOCAL_RUNNER_MEMORY_LIMIT", 256e6)),
+                        file_size_limit=int(getattr(
+                            settings, "CF_LOCAL_RUNNER_FILE_SIZE_LIMIT",
+                            1024*1024)))
+            else:
+                raise ValueError("invalid CF_CODE_RUNNER: '%s'" % kind)
+
+    return _CODE_RUNNER
+
+# }}}
+
+# vim: foldmethod=marker
@@ -37,11 +37,10 @@ import django.core.cache as cache
 from markdown.extensions import Extension
 from markdown.treeprocessors import Treeprocessor
 
-from HTMLParser import HTMLParser
+from jinja2 import (
+        BaseLoader as BaseTemplateLoader, TemplateNotFound, BytecodeCache)
 
-from jinja2 import BaseLoader as BaseTemplateLoader, TemplateNotFound
-
-from courseflow.utils import dict_to_struct
+from courseflow.utils import dict_to_struct, LRUCache
 
 import threading
 
@@ -77,66 +76,160 @@ def get_course_repo(course):
         return repo
 
 
+# Resolving a path means reading every tree object from the commit down to
+# the containing directory. Directory prefix -> tree SHA lookups are
+# memoized per commit so that paths sharing a directory (such as everything
+# under flows/ or media/) cost one lookup plus one tree read.
+
+_REPO_TREE_LRU = LRUCache(getattr(settings, "CF_REPO_TREE_LRU_SIZE", 2000))
+
+
+def _get_repo_tree_sha(repo, dir_names, commit_sha):
+    """Return the SHA of the tree object for the directory given by the
+    tuple of path components *dir_names*. Raises :exc:`KeyError` if
+    that directory does not exist.
+    """
+
+    lru_key = (repo.controldir(), commit_sha, dir_names)
+    tree_sha = _REPO_TREE_LRU.get(lru_key)
+    if tree_sha is not None:
+        return tree_sha
+
+    if not dir_names:
+        tree_sha = repo[commit_sha].tree
+    else:
+        parent_tree = repo[
+                _get_repo_tree_sha(repo, dir_names[:-1], commit_sha)]
+        mode, tree_sha = parent_tree[dir_names[-1].encode()]
+
+    _REPO_TREE_LRU.set(lru_key, tree_sha)
+    return tree_sha
+
+
+# The resolved (path, commit) -> blob SHA mapping is itself memoized, in
+# process and in the shared cache, so that a cache hit on content keyed by
+# blob SHA does not need to read any git objects at all.
+
+_REPO_BLOB_SHA_LRU = LRUCache(getattr(settings, "CF_REPO_TREE_LRU_SIZE", 2000))
+
+
+def get_repo_blob_sha(repo, full_name, commit_sha):
+    """Resolve *full_name* to the SHA of the object it names in the tree of
+    *commit_sha*, without reading the object itself.
+    """
+
+    lru_key = (repo.controldir(), commit_sha, full_name)
+    blob_sha = _REPO_BLOB_SHA_LRU.get(lru_key)
+    if blob_sha is not None:
+        return blob_sha
+
+    from hashlib import sha1
+    cache_key = "%BLOBSHA%" + sha1(
+            ("%s:%s:%s" % lru_key).encode("utf-8")).hexdigest()
+
+    def_cache = cache.caches["default"]
+    blob_sha = def_cache.get(cache_key)
+
+    if blob_sha is None:
+        names = full_name.split("/")
+
+        try:
+            tree = repo[
+                    _get_repo_tree_sha(repo, tuple(names[:-1]), commit_sha)]
+
+            mode, blob_sha = tree[names[-1].encode()]
+        except KeyError:
+            raise ObjectDoesNotExist("resource '%s' not found" % full_name)
+
+        def_cache.add(cache_key, blob_sha, None)
+
+    _REPO_BLOB_SHA_LRU.set(lru_key, blob_sha)
+    return blob_sha
+
+
 def get_repo_blob(repo, full_name, commit_sha):
-    names = full_name.split("/")
+    return repo[get_repo_blob_sha(repo, full_name, commit_sha)]
 
-    tree_sha = repo[commit_sha].tree
-    tree = repo[tree_sha]
 
-    try:
-        for name in names[:-1]:
-            mode, blob_sha = tree[name.encode()]
-            tree = repo[blob_sha]
+# Cache entries below are keyed by the SHA of the blob, not by the commit SHA.
+# That way, files that did not change between two commits keep their cache
+# entries when the course is updated to a new revision.
+#
+# Content at a given commit never changes, so parsed content is additionally
+# kept in a per-process LRU keyed by commit SHA. This saves a round trip to
+# the shared cache (and the unpickling) for hot descriptors. Objects handed
+# out of this cache are shared and must not be modified by callers.
 
-        mode, blob_sha = tree[names[-1].encode()]
-        return repo[blob_sha]
-    except KeyError:
-        raise ObjectDoesNotExist("resource '%s' not found" % full_name)
+_CONTENT_LRU = LRUCache(getattr(settings, "CF_CONTENT_LRU_SIZE", 500))
 
 
 def get_repo_blob_data_cached(repo, full_name, commit_sha):
-    cache_key = "%%%1".join((repo.controldir(), full_name, commit_sha))
+    blob_sha = get_repo_blob_sha(repo, full_name, commit_sha)
+    cache_key = "%%%1" + blob_sha
 
     def_cache = cache.caches["default"]
     result = def_cache.get(cache_key)
     if result is not None:
         return result
 
-    result = get_repo_blob(repo, full_name, commit_sha).data
+    result = repo[blob_sha].data
 
     def_cache.add(cache_key, result, None)
     return result
 
 
 def get_yaml_from_repo_as_dict(repo, full_name, commit_sha):
-    cache_key = "%DICT%%2".join((repo.controldir(), full_name, commit_sha))
+    lru_key = ("yaml_dict", repo.controldir(), full_name, commit_sha)
+    result = _CONTENT_LRU.get(lru_key)
+    if result is not None:
+        return result
+
+    snapshot = get_course_snapshot(repo, commit_sha)
+    if snapshot is not None and full_name in snapshot.yaml:
+        result = snapshot.yaml[full_name]
+        _CONTENT_LRU.set(lru_key, result)
+        return result
+
+    blob_sha = get_repo_blob_sha(repo, full_name, commit_sha)
+    cache_key = "%DICT%%2" + blob_sha
 
     def_cache = cache.caches["default"]
     result = def_cache.get(cache_key)
-    if result is not None:
-        return result
+    if result is None:
+        from yaml import load
+        result = load(repo[blob_sha].data)
 
-    from yaml import load
-    result = load(get_repo_blob(repo, full_name, commit_sha).data)
+        def_cache.add(cache_key, result, None)
 
-    def_cache.add(cache_key, result, None)
+    _CONTENT_LRU.set(lru_key, result)
 
     return result
 
 
 def get_yaml_from_repo(repo, full_name, commit_sha):
-    cache_key = "%%%2".join((repo.controldir(), full_name, commit_sha))
+    lru_key = ("yaml", repo.controldir(), full_name, commit_sha)
+    result = _CONTENT_LRU.get(lru_key)
+    if result is not None:
+        return result
+
+    snapshot = get_course_snapshot(repo, commit_sha)
+    if snapshot is not None and full_name in snapshot.yaml:
+        result = dict_to_struct(snapshot.yaml[full_name])
+        _CONTENT_LRU.set(lru_key, result)
+        return result
+
+    blob_sha = get_repo_blob_sha(repo, full_name, commit_sha)
+    cache_key = "%%%2" + blob_sha
 
     def_cache = cache.caches["default"]
     result = def_cache.get(cache_key)
-    if result is not None:
-        return result
+    if result is None:
+        from yaml import load
+        result = dict_to_struct(load(repo[blob_sha].data))
 
-    from yaml import load
-    result = dict_to_struct(
-            load(get_repo_blob(repo, full_name, commit_sha).data))
+        def_cache.add(cache_key, result, None)
 
-    def_cache.add(cache_key, result, None)
+    _CONTENT_LRU.set(lru_key, result)
 
     return result
 
@@ -154,50 +247,55 @@ def _attr_to_string(key, val):
         return "%s=\"%s\"" % (key, val)
 
 
-class TagProcessingHTMLParser(HTMLParser):
-    def __init__(self, out_file, process_tag_func):
-        HTMLParser.__init__(self)
+# Reversing URLs is comparatively expensive, so link targets are reversed
+# once per (view, course[, commit]) with a placeholder standing in for the
+# variable part of the URL, which is then substituted per link.
 
-        self.out_file = out_file
-        self.process_tag_func = process_tag_func
+_URL_PLACEHOLDER = "CFURLPLACEHOLDER"
 
-    def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
-        attrs.update(self.process_tag_func(tag, attrs))
+# same as what django.core.urlresolvers.reverse leaves unquoted
+_URL_SAFE_CHARS = "!$&'()*+,;=/~:@"
 
-        self.out_file.write("<%s %s>" % (tag, " ".join(
-            _attr_to_string(k, v) for k, v in attrs.iteritems())))
+_REVERSED_URL_LRU = LRUCache(500)
 
-    def handle_endtag(self, tag):
-        self.out_file.write("</%s>" % tag)
 
-    def handle_startendtag(self, tag, attrs):
-        attrs = dict(attrs)
-        attrs.update(self.process_tag_func(tag, attrs))
+def _reverse_cached(view_name, args):
+    lru_key = (view_name,) + args
+    result = _REVERSED_URL_LRU.get(lru_key)
+    if result is None:
+        result = reverse(view_name, args=args)
+        _REVERSED_URL_LRU.set(lru_key, result)
+
+    return result
 
-        self.out_file.write("<%s %s/>" % (tag, " ".join(
-            _attr_to_string(k, v) for k, v in attrs.iteritems())))
 
-    def handle_data(self, data):
-        self.out_file.write(data)
+# The placeholder bypasses the URL pattern's check of the variable part,
+# so these repeat the patterns in courseflow/urls.py.
+_FLOW_ID_URL_RE = re.compile(r"[-_a-zA-Z0-9]+\Z")
+_MEDIA_PATH_URL_RE = re.compile(r".*\Z")
 
-    def handle_entityref(self, name):
-        self.out_file.write("&%s;" % name)
 
-    def handle_charref(self, name):
-        self.out_file.write("&#%s;" % name)
+def _reverse_with_placeholder(view_name, args, value, value_re):
+    if value_re.match(value) is None:
+        # Let reverse() decide (and most likely raise NoReverseMatch).
+        return reverse(view_name, args=args + (value,))
 
-    def handle_comment(self, data):
-        self.out_file.write("<!--%s-->" % data)
+    from django.utils.http import urlquote
+    return (_reverse_cached(view_name, args + (_URL_PLACEHOLDER,))
+            .replace(_URL_PLACEHOLDER, urlquote(value, safe=_URL_SAFE_CHARS)))
 
-    def handle_decl(self, decl):
-        self.out_file.write("<!%s>" % decl)
 
-    def handle_pi(self, data):
-        raise NotImplementedError("I have no idea what a processing instruction is.")
+# Raw HTML blocks that do not match this are left alone entirely.
+LINK_FIXER_CANDIDATE_RE = re.compile(r"<table|flow:|media:|calendar:", re.I)
 
-    def unknown_decl(self, data):
-        self.out_file.write("<![%s]>" % data)
+# Comments are matched (and passed through unchanged) so that commented-out
+# tags are not rewritten.
+LINK_FIXER_TAG_RE = re.compile(
+        r"""<!--.*?(?:-->|\Z)"""
+        r"""|<(a|img|table)\b((?:"[^"]*"|'[^']*'|[^'">])*)>""", re.I | re.S)
+LINK_FIXER_ATTR_RE = re.compile(
+        r"""(\s)(href|src|class)(\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+)""",
+        re.I)
 
 
 class LinkFixerTreeprocessor(Treeprocessor):
@@ -216,20 +314,19 @@ class LinkFixerTreeprocessor(Treeprocessor):
     def process_url(self, url):
         if url.startswith("flow:"):
             flow_id = url[5:]
-            return reverse("course.flow.start_flow",
-                        args=(self.get_course_identifier(), flow_id))
+            return _reverse_with_placeholder("course.flow.start_flow",
+                        (self.get_course_identifier(),), flow_id,
+                        _FLOW_ID_URL_RE)
 
         elif url.startswith("media:"):
             media_path = url[6:]
-            return reverse("course.views.get_media",
-                        args=(
-                            self.get_course_identifier(),
-                            self.commit_sha,
-                            media_path))
+            return _reverse_with_placeholder("course.views.get_media",
+                        (self.get_course_identifier(), self.commit_sha),
+                        media_path, _MEDIA_PATH_URL_RE)
 
         elif url.strip() == "calendar:":
-            return reverse("course.calendar.view_calendar",
-                        args=(self.get_course_identifier(),))
+            return _reverse_cached("course.calendar.view_calendar",
+                        (self.get_course_identifier(),))
 
         return None
 
@@ -265,29 +362,91 @@ class LinkFixerTreeprocessor(Treeprocessor):
         for child in root:
             self.walk_and_process_tree(child)
 
-    def run(self, root):
-        self.walk_and_process_tree(root)
+    def process_html_tag(self, match):
+        if match.group(1) is None:
+            # a comment
+            return match.group(0)
+
+        tag_name = match.group(1).lower()
+        attrs_str = match.group(2)
+
+        attrs = {}
+        for attr_match in LINK_FIXER_ATTR_RE.finditer(attrs_str):
+            value = attr_match.group(4)
+            if value[:1] in "\"'":
+                value = value[1:-1]
+            attrs[attr_match.group(2).lower()] = value
+
+        changed_attrs = self.process_tag(tag_name, attrs)
+        if not changed_attrs:
+            return match.group(0)
+
+        def replace_attr(attr_match):
+            key = attr_match.group(2).lower()
+            if key not in changed_attrs:
+                return attr_match.group(0)
+
+            return attr_match.group(1) + _attr_to_string(
+                    attr_match.group(2), changed_attrs.pop(key))
+
+        attrs_str = LINK_FIXER_ATTR_RE.sub(replace_attr, attrs_str)
+
+        # add attributes that were not there before
+        if changed_attrs:
+            if attrs_str.endswith("/"):
+                attrs_str, end = attrs_str[:-1], "/"
+            else:
+                end = ""
+
+            attrs_str = "%s %s%s" % (
+                    attrs_str,
+                    " ".join(
+                        _attr_to_string(key, val)
+                        for key, val in changed_attrs.iteritems()),
+                    end)
+
+        return "<%s%s>" % (match.group(1), attrs_str)
+
+    def process_html(self, html):
+        if LINK_FIXER_CANDIDATE_RE.search(html) is None:
+            return html
 
-        # root through and process Markdown's HTML stash (gross!)
-        from StringIO import StringIO
+        return LINK_FIXER_TAG_RE.sub(self.process_html_tag, html)
 
-        for i, (html, safe) in enumerate(self.md.htmlStash.rawHtmlBlocks):
-            outf = StringIO()
-            parser = TagProcessingHTMLParser(outf, self.process_tag)
-            parser.feed(html)
+    def run(self, root):
+        self.walk_and_process_tree(root)
 
-            self.md.htmlStash.rawHtmlBlocks[i] = (outf.getvalue(), safe)
+        # Process Markdown's HTML stash, which the tree walk does not see.
+        # Only the relevant attributes are rewritten, everything else is
+        # passed through verbatim.
+        raw_html_blocks = self.md.htmlStash.rawHtmlBlocks
+        for i, (html, safe) in enumerate(raw_html_blocks):
+            raw_html_blocks[i] = (self.process_html(html), safe)
 
 
 class LinkFixerExtension(Extension):
     def __init__(self, course, commit_sha):
         Extension.__init__(self)
+        self.course = course
+        self.commit_sha = commit_sha
+        self.treeprocessor = None
+
+    def set_context(self, course, commit_sha):
+        """Change the course and commit that links are fixed up for. This
+        allows an already-configured Markdown engine to be reused.
+        """
+
         self.course = course
         self.commit_sha = commit_sha
 
+        if self.treeprocessor is not None:
+            self.treeprocessor.course = course
+            self.treeprocessor.commit_sha = commit_sha
+
     def extendMarkdown(self, md, md_globals):
-        md.treeprocessors["courseflow_link_fixer"] = \
+        self.treeprocessor = \
                 LinkFixerTreeprocessor(md, self.course, self.commit_sha)
+        md.treeprocessors["courseflow_link_fixer"] = self.treeprocessor
 
 
 class GitTemplateLoader(BaseTemplateLoader):
@@ -304,11 +463,64 @@ class GitTemplateLoader(BaseTemplateLoader):
         source = data.decode('utf-8')
 
         def is_up_to_date():
-            # There's not much point to caching here, because we create
-            # a new loader for every request anyhow...
-            return False
+            # Each loader serves a single commit, and commits are immutable.
+            return True
+
+        return source, None, is_up_to_date
+
+
+class DjangoCacheBytecodeCache(BytecodeCache):
+    """Stores compiled Jinja template bytecode in Django's default cache.
+    Jinja checks the stored source checksum, so bytecode for a template
+    that changed between commits is never reused. Entries are kept per
+    repository and commit, so that same-named templates of different
+    courses do not keep replacing each other.
+    """
+
+    def __init__(self, repo, commit_sha):
+        self.key_prefix = "%s:%s:" % (repo.controldir(), commit_sha)
 
-        return source, None, lambda: False
+    def _get_cache_key(self, bucket):
+        from hashlib import sha1
+        return "%JINJA%" + sha1(
+                (self.key_prefix + bucket.key).encode("utf-8")).hexdigest()
+
+    def load_bytecode(self, bucket):
+        code = cache.caches["default"].get(self._get_cache_key(bucket))
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        cache.caches["default"].set(
+                self._get_cache_key(bucket), bucket.bytecode_to_string(),
+                None)
+
+
+def get_jinja_environment(repo, commit_sha):
+    """Return a :class:`jinja2.Environment` loading templates from
+    *commit_sha* in *repo*. Environments (and hence their compiled
+    templates) are kept per thread, because they hold on to *repo*, which is
+    not safe to share between threads.
+    """
+
+    try:
+        envs = _THREAD_LOCAL_STORAGE.JINJA_ENVIRONMENTS
+    except AttributeError:
+        envs = _THREAD_LOCAL_STORAGE.JINJA_ENVIRONMENTS = LRUCache(
+                getattr(settings, "CF_JINJA_ENV_LRU_SIZE", 10))
+
+    lru_key = (repo.controldir(), commit_sha)
+    env = envs.get(lru_key)
+    if env is not None:
+        return env
+
+    from jinja2 import Environment
+    env = Environment(
+            loader=GitTemplateLoader(repo, commit_sha),
+            bytecode_cache=DjangoCacheBytecodeCache(repo, commit_sha))
+
+    envs.set(lru_key, env)
+    return env
 
 
 def remove_prefix(prefix, s):
@@ -321,26 +533,272 @@ def remove_prefix(prefix, s):
 JINJA_PREFIX = "[JINJA]"
 
 
-def markup_to_html(course, repo, commit_sha, text):
-    if text.lstrip().startswith(JINJA_PREFIX):
-        text = remove_prefix(JINJA_PREFIX, text.lstrip())
+def get_markup_hash(text):
+    from hashlib import sha1
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return sha1(text).hexdigest()
 
-        from jinja2 import Environment
-        env = Environment(loader=GitTemplateLoader(repo, commit_sha))
-        template = env.from_string(text)
-        text = template.render()
+
+# Setting up a Markdown engine (resolving and instantiating all the
+# extensions) is costly compared to converting a typical snippet, so
+# configured engines are kept in a per-thread pool and reset between uses.
+
+def make_markdown_engine():
+    """Return a tuple *(md, link_fixer)* of a configured
+    :class:`markdown.Markdown` instance and its :class:`LinkFixerExtension`.
+    """
 
     from course.mdx_mathjax import MathJaxExtension
     import markdown
-    return markdown.markdown(text,
+
+    link_fixer = LinkFixerExtension(None, None)
+    md = markdown.Markdown(
         extensions=[
-            LinkFixerExtension(course, commit_sha),
+            link_fixer,
             MathJaxExtension(),
             "extra",
             "codehilite",
             ],
         output_format="html5")
 
+    return md, link_fixer
+
+
+def get_markdown_engine_pool():
+    try:
+        return _THREAD_LOCAL_STORAGE.MARKDOWN_ENGINES
+    except AttributeError:
+        _THREAD_LOCAL_STORAGE.MARKDOWN_ENGINES = []
+        return _THREAD_LOCAL_STORAGE.MARKDOWN_ENGINES
+
+
+def _render_markup(course, repo, commit_sha, text):
+    if text.lstrip().startswith(JINJA_PREFIX):
+        text = remove_prefix(JINJA_PREFIX, text.lstrip())
+
+        env = get_jinja_environment(repo, commit_sha)
+        template = env.from_string(text)
+        text = template.render()
+
+    pool = get_markdown_engine_pool()
+    if pool:
+        md, link_fixer = pool.pop()
+    else:
+        md, link_fixer = make_markdown_engine()
+
+    try:
+        link_fixer.set_context(course, commit_sha)
+        md.reset()
+        return md.convert(text)
+    finally:
+        link_fixer.set_context(None, None)
+        md.reset()
+        pool.append((md, link_fixer))
+
+
+# The rendered HTML only depends on the course (through link fixing), the
+# commit (through media links and Jinja includes) and the text itself, so it
+# is rendered once per commit and then cached, first in-process and then in
+# the shared cache.
+
+_MARKUP_LRU = LRUCache(getattr(settings, "CF_MARKUP_LRU_SIZE", 2000))
+
+
+def markup_to_html(course, repo, commit_sha, text):
+    text_hash = get_markup_hash(text)
+
+    if course is not None:
+        snapshot = get_course_snapshot(repo, commit_sha)
+        if snapshot is not None:
+            result = snapshot.markup_html.get(text_hash)
+            if result is not None:
+                return result
+
+        course_identifier = course.identifier
+    else:
+        course_identifier = None
+
+    lru_key = (course_identifier, commit_sha, text_hash)
+    result = _MARKUP_LRU.get(lru_key)
+    if result is not None:
+        return result
+
+    from hashlib import sha1
+    cache_key = "%MARKUP%" + sha1(
+            "%s%%%s%%%s" % (course_identifier, commit_sha, text_hash)).hexdigest()
+
+    def_cache = cache.caches["default"]
+    result = def_cache.get(cache_key)
+    if result is None:
+        result = _render_markup(course, repo, commit_sha, text)
+        def_cache.add(cache_key, result, None)
+
+    _MARKUP_LRU.set(lru_key, result)
+
+    return result
+
+# }}}
+
+
+# {{{ content snapshots
+
+# When a commit is activated for a course, all of its YAML content and the
+# markup shown on the course page and in flows are compiled (in the
+# background, or by the compile_course_snapshots management command) into a
+# single pickled snapshot stored outside the repository. Workers load the
+# snapshot lazily, after which requests for that commit need neither
+# dulwich, YAML parsing nor Markdown rendering.
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+_SNAPSHOT_LRU = LRUCache(getattr(settings, "CF_CONTENT_SNAPSHOT_LRU_SIZE", 4))
+
+# Stored in _SNAPSHOT_LRU, along with the time of the check, for commits
+# without a snapshot. Other processes may compile the snapshot later, so
+# such entries are only trusted for a short while.
+_NO_SNAPSHOT = object()
+_NO_SNAPSHOT_RECHECK_INTERVAL = 30
+
+
+class CourseSnapshot(object):
+    """
+    .. attribute:: commit_sha
+    .. attribute:: yaml
+
+        A dictionary mapping repository paths to their parsed YAML content,
+        as plain data (i.e. not converted to structs).
+
+    .. attribute:: markup_html
+
+        A dictionary mapping :func:`get_markup_hash` values of markup strings
+        to their rendered HTML.
+    """
+
+    def __init__(self, commit_sha, yaml, markup_html):
+        self.format_version = SNAPSHOT_FORMAT_VERSION
+        self.commit_sha = commit_sha
+        self.yaml = yaml
+        self.markup_html = markup_html
+
+
+def get_course_snapshot_dir():
+    """Return the directory holding content snapshots, as given by the
+    ``CF_CONTENT_SNAPSHOT_DIR`` setting. Defaults to a directory
+    ``.courseflow-snapshots`` below ``GIT_ROOT``, next to (and not inside)
+    the course repositories.
+    """
+    from os.path import join
+    return getattr(settings, "CF_CONTENT_SNAPSHOT_DIR",
+            join(settings.GIT_ROOT, ".courseflow-snapshots"))
+
+
+def get_course_snapshot_path(repo, commit_sha):
+    # Rendered markup refers to the course by identifier, so snapshots are
+    # kept per repository (i.e. per course) even if commits are shared.
+    from os.path import join, basename, normpath
+    return join(get_course_snapshot_dir(), basename(normpath(repo.path)),
+            "%s.pickle" % commit_sha)
+
+
+def get_course_snapshot(repo, commit_sha):
+    """Return the :class:`CourseSnapshot` for *commit_sha*, or *None* if
+    none has been compiled.
+    """
+
+    if not getattr(settings, "CF_CONTENT_SNAPSHOTS", True):
+        return None
+
+    from time import time
+
+    lru_key = (repo.controldir(), commit_sha)
+    snapshot = _SNAPSHOT_LRU.get(lru_key)
+    if isinstance(snapshot, tuple) and snapshot[0] is _NO_SNAPSHOT:
+        if time() - snapshot[1] < _NO_SNAPSHOT_RECHECK_INTERVAL:
+            return None
+    elif snapshot is not None:
+        return snapshot
+
+    from cPickle import load
+    try:
+        with open(get_course_snapshot_path(repo, commit_sha), "rb") as inf:
+            snapshot = load(inf)
+    except IOError:
+        snapshot = None
+
+    if getattr(snapshot, "format_version", None) != SNAPSHOT_FORMAT_VERSION:
+        _SNAPSHOT_LRU.set(lru_key, (_NO_SNAPSHOT, time()))
+        return None
+
+    _SNAPSHOT_LRU.set(lru_key, snapshot)
+    return snapshot
+
+
+def compile_course_snapshot(repo, course, commit_sha):
+    from yaml import load
+
+    yaml = {}
+    markup = []
+
+    def load_yaml(full_name):
+        result = load(get_repo_blob(repo, full_name, commit_sha).data)
+        yaml[full_name] = result
+        return dict_to_struct(result)
+
+    course_desc = load_yaml(course.course_file)
+    for chunk in course_desc.chunks:
+        markup.append(chunk.content)
+
+    try:
+        load_yaml(course.events_file)
+    except ObjectDoesNotExist:
+        # That's OK--no calendar info.
+        pass
+
+    try:
+        flows_tree = get_repo_blob(repo, "flows", commit_sha)
+    except ObjectDoesNotExist:
+        # That's OK--no flows yet.
+        pass
+    else:
+        for entry in flows_tree.items():
+            flow_desc = load_yaml("flows/%s" % entry.path)
+
+            markup.append(getattr(flow_desc, "description", None))
+            markup.append(getattr(flow_desc, "completion_text", None))
+
+            for grp in flow_desc.groups:
+                for page_desc in grp.pages:
+                    markup.append(getattr(page_desc, "content", None))
+                    markup.append(getattr(page_desc, "prompt", None))
+
+    markup_html = {}
+    for text in markup:
+        if text is not None:
+            markup_html[get_markup_hash(text)] = markup_to_html(
+                    course, repo, commit_sha, text)
+
+    snapshot = CourseSnapshot(commit_sha, yaml, markup_html)
+
+    import os
+    from cPickle import dump, HIGHEST_PROTOCOL
+
+    snapshot_path = get_course_snapshot_path(repo, commit_sha)
+    snapshot_dir = os.path.dirname(snapshot_path)
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    # Write to a temporary file first so that workers never see a partially
+    # written snapshot.
+    tmp_path = "%s.%d.tmp" % (snapshot_path, os.getpid())
+    with open(tmp_path, "wb") as outf:
+        dump(snapshot, outf, HIGHEST_PROTOCOL)
+    os.rename(tmp_path, snapshot_path)
+
+    _SNAPSHOT_LRU.set((repo.controldir(), commit_sha), snapshot)
+
+    return snapshot
+
 # }}}
 
 
@@ -354,7 +812,128 @@ class InvalidDatespec(ValueError):
         self.datespec = datespec
 
 
-def parse_date_spec(course, datespec, return_now_on_error=True):
+# {{{ event index
+
+# All events of a course are loaded with a single query into an index that
+# lives in the shared cache. Each index is tagged with a version derived from
+# its content, so that anything derived from event times can be keyed on it
+# and stays valid for as long as the events do not change.
+#
+# Saving or deleting an Event drops the index (see the signal handlers in
+# course.models). If that happens inside a transaction, a concurrent request
+# may rebuild the index from the not yet committed state, so the index is
+# dropped once more after the transaction is over: at the end of the request
+# by EventIndexInvalidationMiddleware, or by the next get_event_index call
+# in the same thread. The timeout is only a safety net in case both of those
+# are missed.
+
+EVENT_INDEX_TIMEOUT = 24*3600
+
+
+class EventIndex(object):
+    """
+    .. attribute:: version
+
+        A string that changes whenever the events change.
+
+    .. attribute:: times
+
+        A dictionary mapping *(kind, ordinal)* to the event's time.
+        *ordinal* may be *None*.
+    """
+
+    def __init__(self, version, times):
+        self.version = version
+        self.times = times
+
+
+def _get_event_index_cache_key(course_id):
+    return "%%EVENTS%%%d" % course_id
+
+
+def _get_event_index_version(times):
+    from hashlib import sha1
+    return sha1(repr(sorted(
+        (kind, ordinal, time.isoformat())
+        for (kind, ordinal), time in times.iteritems()))).hexdigest()
+
+
+def get_event_index(course):
+    flush_event_index_invalidations()
+
+    cache_key = _get_event_index_cache_key(course.pk)
+
+    def_cache = cache.caches["default"]
+    result = def_cache.get(cache_key)
+    if result is not None:
+        return result
+
+    from course.models import Event
+    times = dict(
+            ((kind, ordinal), time)
+            for kind, ordinal, time in (
+                Event.objects
+                .filter(course=course)
+                .values_list("kind", "ordinal", "time")))
+
+    result = EventIndex(_get_event_index_version(times), times)
+
+    def_cache.add(cache_key, result, EVENT_INDEX_TIMEOUT)
+
+    return result
+
+
+# IDs of courses whose event index is to be dropped again once the current
+# transaction is over.
+_PENDING_EVENT_INDEX_INVALIDATIONS = threading.local()
+
+
+def invalidate_event_index(course_id):
+    cache.caches["default"].delete(_get_event_index_cache_key(course_id))
+
+    from django.db import connection
+    if connection.in_atomic_block:
+        try:
+            pending = _PENDING_EVENT_INDEX_INVALIDATIONS.course_ids
+        except AttributeError:
+            pending = _PENDING_EVENT_INDEX_INVALIDATIONS.course_ids = set()
+
+        pending.add(course_id)
+
+
+def flush_event_index_invalidations():
+    """Drop the event indices invalidated during a transaction that has
+    since ended. Does nothing while a transaction is still open.
+    """
+
+    pending = getattr(_PENDING_EVENT_INDEX_INVALIDATIONS, "course_ids", None)
+    if not pending:
+        return
+
+    from django.db import connection
+    if connection.in_atomic_block:
+        return
+
+    _PENDING_EVENT_INDEX_INVALIDATIONS.course_ids = set()
+    cache.caches["default"].delete_many([
+        _get_event_index_cache_key(course_id) for course_id in pending])
+
+
+class EventIndexInvalidationMiddleware(object):
+    def process_response(self, request, response):
+        flush_event_index_invalidations()
+        return response
+
+# }}}
+
+
+def parse_date_spec(course, datespec, return_now_on_error=True,
+        event_index=None):
+    """
+    :arg event_index: an :class:`EventIndex` to resolve symbolic datespecs
+        against. If not given, the course's index is fetched from the cache.
+    """
+
     if isinstance(datespec, datetime.datetime):
         return datespec
     if isinstance(datespec, datetime.date):
@@ -369,35 +948,124 @@ def parse_date_spec(course, datespec, return_now_on_error=True):
                 int(match.group(2)),
                 int(match.group(3)))
 
-    from course.models import Event
-
     match = TRAILING_NUMERAL_RE.match(datespec)
     if match:
-        try:
-            return Event.objects.get(
-                    course=course,
-                    kind=match.group(1),
-                    ordinal=int(match.group(2))).time
-        except ObjectDoesNotExist:
-            if return_now_on_error:
-                return now()
-            else:
-                raise InvalidDatespec(datespec)
+        event_key = (match.group(1), int(match.group(2)))
+    else:
+        event_key = (datespec, None)
+
+    if event_index is None:
+        event_index = get_event_index(course)
 
     try:
-        return Event.objects.get(
-                course=course,
-                kind=datespec,
-                ordinal=None).time
-    except ObjectDoesNotExist:
+        return event_index.times[event_key]
+    except KeyError:
         if return_now_on_error:
             return now()
         else:
             raise InvalidDatespec(datespec)
 
 
-def compute_chunk_weight_and_shown(course, chunk, role, now_datetime):
-    for rule in chunk.rules:
+# {{{ rule evaluation
+
+# Rule lists (chunk rules, flow access rules) are compiled once per commit,
+# event index version and role, with all datespecs already resolved.
+
+_RULE_EVALUATOR_LRU = LRUCache(
+        getattr(settings, "CF_RULE_EVALUATOR_LRU_SIZE", 2000))
+
+# Stands in for a datespec that did not resolve. As in :func:`parse_date_spec`,
+# such a date is taken to be the (real) current time when the rule is
+# evaluated.
+_UNRESOLVED_DATE = object()
+
+
+class RuleEvaluator(object):
+    """Finds the first rule of a list (filtered for one role) that applies
+    at a given time.
+
+    .. attribute:: entries
+
+        A list of tuples *(start, end, value)*. *start* and *end* may be
+        *None* if the rule has no such constraint.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def evaluate(self, now_datetime):
+        """
+        :returns: a tuple *(value, last_change, next_change)*. *value* is
+            that of the first applicable rule, or *None* if no rule applies.
+            The answer is the same for all times from *last_change*
+            (inclusive) up to *next_change* (exclusive). Either may be
+            *None* if the answer has been the same for all times before or
+            stays the same for all times after *now_datetime*.
+        """
+
+        real_now = None
+        last_changes = []
+        next_changes = []
+
+        def make_result(value):
+            return (value,
+                    max(last_changes) if last_changes else None,
+                    min(next_changes) if next_changes else None)
+
+        for start, end, value in self.entries:
+            # Unresolved dates move along with the real time, so they
+            # contribute no boundaries.
+            start_is_boundary = start is not _UNRESOLVED_DATE
+            end_is_boundary = end is not _UNRESOLVED_DATE
+
+            if not (start_is_boundary and end_is_boundary):
+                if real_now is None:
+                    real_now = now()
+                if not start_is_boundary:
+                    start = real_now
+                if not end_is_boundary:
+                    end = real_now
+
+            if start is not None and now_datetime < start:
+                if start_is_boundary:
+                    next_changes.append(start)
+                continue
+
+            if end is not None and end < now_datetime:
+                if end_is_boundary:
+                    last_changes.append(
+                            end + datetime.timedelta(microseconds=1))
+                continue
+
+            if start is not None and start_is_boundary:
+                last_changes.append(start)
+            if end is not None and end_is_boundary:
+                next_changes.append(end + datetime.timedelta(microseconds=1))
+
+            return make_result(value)
+
+        return make_result(None)
+
+
+def _resolve_rule_date(course, rule, attr_name, event_index):
+    if not hasattr(rule, attr_name):
+        return None
+
+    try:
+        return parse_date_spec(course, getattr(rule, attr_name),
+                return_now_on_error=False, event_index=event_index)
+    except InvalidDatespec:
+        return _UNRESOLVED_DATE
+
+
+def compile_rules(course, rules, role, event_index, get_value):
+    """
+    :arg get_value: a function mapping a rule to the value that
+        :meth:`RuleEvaluator.evaluate` returns when that rule applies.
+    """
+
+    entries = []
+    for rule in rules:
         if hasattr(rule, "role"):
             if role != rule.role:
                 continue
@@ -406,56 +1074,205 @@ def compute_chunk_weight_and_shown(course, chunk, role, now_datetime):
             if role not in rule.roles:
                 continue
 
-        if hasattr(rule, "start"):
-            start_date = parse_date_spec(course, rule.start)
-            if now_datetime < start_date:
-                continue
-        if hasattr(rule, "end"):
-            end_date = parse_date_spec(course, rule.end)
-            if end_date < now_datetime:
-                continue
+        entries.append((
+            _resolve_rule_date(course, rule, "start", event_index),
+            _resolve_rule_date(course, rule, "end", event_index),
+            get_value(rule)))
+
+    return RuleEvaluator(entries)
+
+
+def _get_rule_evaluator(kind, course, commit_sha, rules_id, rules, role,
+        event_index, get_value):
+    if event_index is None:
+        event_index = get_event_index(course)
+
+    lru_key = None
+    if commit_sha is not None:
+        lru_key = (kind, course.pk, commit_sha, event_index.version,
+                rules_id, role)
+        evaluator = _RULE_EVALUATOR_LRU.get(lru_key)
+        if evaluator is not None:
+            return evaluator
+
+    evaluator = compile_rules(course, rules, role, event_index, get_value)
+
+    if lru_key is not None:
+        _RULE_EVALUATOR_LRU.set(lru_key, evaluator)
+
+    return evaluator
+
+
+def _get_chunk_rule_value(rule):
+    shown = True
+    if hasattr(rule, "shown"):
+        shown = rule.shown
+
+    return rule.weight, shown
 
-        shown = True
-        if hasattr(rule, "shown"):
-            shown = rule.shown
 
-        return rule.weight, shown
+def get_chunk_rule_evaluator(course, commit_sha, chunk, role,
+        event_index=None):
+    """
+    :arg commit_sha: the commit *chunk* was read from. If *None*, the
+        compiled rules are not cached.
+    :returns: a :class:`RuleEvaluator` whose values are tuples
+        *(weight, shown)*.
+    """
+    return _get_rule_evaluator("chunk", course, commit_sha, chunk.id,
+            chunk.rules, role, event_index, _get_chunk_rule_value)
 
-    return 0, True
+
+def get_flow_rule_evaluator(course, commit_sha, flow_id, flow_desc, role,
+        event_index=None):
+    """
+    :arg commit_sha: the commit *flow_desc* was read from. If *None*, the
+        compiled rules are not cached.
+    :returns: a :class:`RuleEvaluator` whose values are access rules, or
+        *None* if *flow_desc* has no access rules.
+    """
+    if not hasattr(flow_desc, "access_rules"):
+        return None
+
+    return _get_rule_evaluator("flow", course, commit_sha, flow_id,
+            flow_desc.access_rules, role, event_index, lambda rule: rule)
+
+# }}}
 
 
 def get_course_desc(repo, course, commit_sha):
     return get_yaml_from_repo(repo, course.course_file, commit_sha)
 
 
+def _get_course_chunks_cache_key(course, commit_sha, role, event_index):
+    return "%%%%CHUNKS%%%%%d%%%s%%%s%%%s" % (
+            course.pk, commit_sha, role, event_index.version)
+
+
 def get_processed_course_chunks(course, repo, commit_sha,
         course_desc, role, now_datetime):
+    # The result only depends on the commit, the role, the events and on
+    # where *now_datetime* falls relative to the dates in the chunk rules.
+    # It is cached along with the time span over which it remains valid.
+
+    event_index = get_event_index(course)
+
+    cache_key = _get_course_chunks_cache_key(
+            course, commit_sha, role, event_index)
+
+    def_cache = cache.caches["default"]
+    cached = def_cache.get(cache_key)
+    if cached is not None:
+        valid_from, valid_until, chunks = cached
+        if ((valid_from is None or valid_from <= now_datetime)
+                and (valid_until is None or now_datetime < valid_until)):
+            return chunks
+
+    # course_desc may be shared with other requests, so annotate copies of
+    # the chunks rather than the chunks themselves.
+    from copy import copy
+
+    chunks = []
+    valid_from = None
+    valid_until = None
     for chunk in course_desc.chunks:
-        chunk.weight, chunk.shown = \
-                compute_chunk_weight_and_shown(
-                        course, chunk, role, now_datetime)
+        evaluator = get_chunk_rule_evaluator(
+                course, commit_sha, chunk, role, event_index=event_index)
+        result, last_change, next_change = evaluator.evaluate(now_datetime)
+
+        if last_change is not None and (
+                valid_from is None or last_change > valid_from):
+            valid_from = last_change
+        if next_change is not None and (
+                valid_until is None or next_change < valid_until):
+            valid_until = next_change
+
+        if result is None:
+            result = 0, True
+
+        chunk = copy(chunk)
+        chunk.weight, chunk.shown = result
+        if not chunk.shown:
+            continue
+
         chunk.html_content = markup_to_html(course, repo, commit_sha, chunk.content)
+        chunks.append(chunk)
+
+    chunks.sort(key=lambda chunk: chunk.weight, reverse=True)
+
+    # Only store results that hold at the real current time. This keeps
+    # requests with a fake time from replacing the entry everybody else
+    # uses.
+    real_now = now()
+    if valid_from is not None and real_now < valid_from:
+        return chunks
+
+    if valid_until is None:
+        def_cache.set(cache_key, (valid_from, None, chunks))
+    else:
+        timeout = (valid_until - real_now).total_seconds()
+        if timeout >= 1:
+            def_cache.set(cache_key, (valid_from, valid_until, chunks),
+                    int(timeout))
+
+    return chunks
+
+
+def _index_flow_desc(flow_desc):
+    """Attach lookup tables for the pages of *flow_desc*:
+
+    .. attribute:: page_desc_index
+
+        A dictionary mapping *(group_id, page_id)* to the page descriptor.
 
-    course_desc.chunks.sort(key=lambda chunk: chunk.weight, reverse=True)
+    .. attribute:: page_keys_by_ordinal
 
-    return [chunk for chunk in course_desc.chunks
-            if chunk.shown]
+        A list of *(group_id, page_id)*, in flow order.
+    """
+
+    flow_desc.page_desc_index = {}
+    flow_desc.page_keys_by_ordinal = []
+
+    for grp in flow_desc.groups:
+        for page_desc in grp.pages:
+            key = (grp.id, page_desc.id)
+            flow_desc.page_desc_index[key] = page_desc
+            flow_desc.page_keys_by_ordinal.append(key)
 
 
 def get_flow_desc(repo, course, flow_id, commit_sha):
-    flow = get_yaml_from_repo(repo, "flows/%s.yml" % flow_id, commit_sha)
+    lru_key = ("flow_desc", course.identifier, flow_id, commit_sha)
+    flow = _CONTENT_LRU.get(lru_key)
+    if flow is not None:
+        return flow
+
+    from copy import copy
+    flow = copy(get_yaml_from_repo(repo, "flows/%s.yml" % flow_id, commit_sha))
 
     flow.description_html = markup_to_html(
             course, repo, commit_sha, getattr(flow, "description", None))
+
+    _index_flow_desc(flow)
+
+    _CONTENT_LRU.set(lru_key, flow)
     return flow
 
 
 def get_flow_page_desc(flow_id, flow_desc, group_id, page_id):
-    for grp in flow_desc.groups:
-        if grp.id == group_id:
-            for page in grp.pages:
-                if page.id == page_id:
-                    return page
+    page_desc_index = getattr(flow_desc, "page_desc_index", None)
+
+    if page_desc_index is not None:
+        try:
+            return page_desc_index[group_id, page_id]
+        except KeyError:
+            pass
+
+    else:
+        for grp in flow_desc.groups:
+            if grp.id == group_id:
+                for page in grp.pages:
+                    if page.id == page_id:
+                        return page
 
     raise ObjectDoesNotExist("page '%s/%s' in flow '%s'"
             % (group_id, page_id, flow_id))
@@ -487,6 +1304,32 @@ def import_class(name):
     return mod
 
 
+# Modules from the course repository, keyed by blob SHA, so that a module
+# is only executed once per version of its source.
+_REPO_MODULE_LRU = LRUCache(getattr(settings, "CF_REPO_MODULE_LRU_SIZE", 50))
+
+
+def get_repo_module_dict(repo, module_name, commit_sha):
+    """Execute the Python source file *module_name* from the course
+    repository and return the resulting namespace. The namespace is shared
+    and must not be modified.
+    """
+
+    blob_sha = get_repo_blob_sha(repo, module_name, commit_sha)
+
+    module_dict = _REPO_MODULE_LRU.get(blob_sha)
+    if module_dict is not None:
+        return module_dict
+
+    module_code = repo[blob_sha].data
+
+    module_dict = {}
+    exec(compile(module_code, module_name, 'exec'), module_dict)
+
+    _REPO_MODULE_LRU.set(blob_sha, module_dict)
+    return module_dict
+
+
 def get_flow_page_class(repo, typename, commit_sha):
     # look among default page types
     import course.page
@@ -511,15 +1354,11 @@ def get_flow_page_class(repo, typename, commit_sha):
 
         module, classname = components
         module_name = "code/"+module+".py"
-        module_code = get_repo_blob(repo, module_name, commit_sha).data
-
-        module_dict = {}
-
-        exec(compile(module_code, module_name, 'exec'), module_dict)
+        module_dict = get_repo_module_dict(repo, module_name, commit_sha)
 
         try:
             return module_dict[classname]
-        except AttributeError:
+        except KeyError:
             raise ClassNotFoundError(typename)
     else:
         raise ClassNotFoundError(typename)
@@ -531,33 +1370,208 @@ def instantiate_flow_page(location, repo, page_desc, commit_sha):
     return class_(None, location, page_desc)
 
 
+# Page objects do not change after construction, so one instance per page
+# and commit can be shared by all requests that a server process handles.
+_PAGE_INSTANCE_LRU = LRUCache(
+        getattr(settings, "CF_PAGE_INSTANCE_LRU_SIZE", 2000))
+
+
+def get_flow_page(repo, course_identifier, flow_id, flow_desc,
+        group_id, page_id, commit_sha):
+    """Return a (possibly shared) instance of the page *group_id/page_id*
+    from *flow_desc*, which must have been read from *commit_sha*.
+    """
+
+    lru_key = (course_identifier, commit_sha, flow_id, group_id, page_id)
+    page = _PAGE_INSTANCE_LRU.get(lru_key)
+    if page is not None:
+        return page
+
+    page_desc = get_flow_page_desc(flow_id, flow_desc, group_id, page_id)
+
+    page = instantiate_flow_page(
+            "course '%s', flow '%s', page '%s/%s'"
+            % (course_identifier, flow_id, group_id, page_id),
+            repo, page_desc, commit_sha)
+
+    _PAGE_INSTANCE_LRU.set(lru_key, page)
+    return page
+
+
 def set_up_flow_session_page_data(repo, flow_session,
         course_identifier, flow_desc, commit_sha):
+    """Create the :class:`course.models.FlowPageData` for all pages of
+    *flow_session*, which is saved (once) along the way. The page data is
+    written with a single bulk insert.
+
+    If the flow sets ``lazy_page_data``, no page data is created here.
+    Instead, it is created (reproducibly) when it is first needed, see
+    :func:`get_flow_session_page_data`.
+
+    :returns: the number of pages in the flow.
+    """
+
     from course.models import FlowPageData
 
-    data = None
+    if getattr(flow_desc, "lazy_page_data", False):
+        # Page data is created on demand, see get_flow_session_page_data.
+        flow_session.page_count = sum(len(grp.pages) for grp in flow_desc.groups)
+        flow_session.save()
+        return flow_session.page_count
+
+    all_page_data = []
 
-    ordinal = 0
     for grp in flow_desc.groups:
         for page_desc in grp.pages:
             data = FlowPageData()
-            data.flow_session = flow_session
-            data.ordinal = ordinal
-            data.is_last = False
+            data.ordinal = len(all_page_data)
             data.group_id = grp.id
             data.page_id = page_desc.id
 
-            page = instantiate_flow_page(
-                    "course '%s', flow '%s', page '%s/%s'"
-                    % (course_identifier, flow_session.flow_id,
-                        grp.id, page_desc.id),
-                    repo, page_desc, commit_sha)
+            page = get_flow_page(repo, course_identifier,
+                    flow_session.flow_id, flow_desc, grp.id, page_desc.id,
+                    commit_sha)
             data.data = page.make_page_data()
+
+            all_page_data.append(data)
+
+    flow_session.page_count = len(all_page_data)
+    flow_session.save()
+
+    for data in all_page_data:
+        data.flow_session = flow_session
+
+    FlowPageData.objects.bulk_create(all_page_data)
+
+    return len(all_page_data)
+
+
+# {{{ lazily created page data
+
+def get_flow_page_data_seed(flow_session, ordinal):
+    from hashlib import sha1
+    return int(sha1("%d:%d" % (flow_session.pk, ordinal)).hexdigest()[:15], 16)
+
+
+def _make_lazy_flow_page_data(repo, course, flow_session, ordinal):
+    from course.models import FlowPageData
+
+    commit_sha = flow_session.active_git_commit_sha.encode()
+    flow_desc = get_flow_desc(repo, course, flow_session.flow_id, commit_sha)
+
+    group_id, page_id = flow_desc.page_keys_by_ordinal[ordinal]
+    page = get_flow_page(repo, course.identifier, flow_session.flow_id,
+            flow_desc, group_id, page_id, commit_sha)
+
+    data = FlowPageData()
+    data.flow_session = flow_session
+    data.ordinal = ordinal
+    data.group_id = group_id
+    data.page_id = page_id
+    data.data = page.make_seeded_page_data(
+            get_flow_page_data_seed(flow_session, ordinal))
+
+    return data
+
+
+def get_flow_session_page_data(repo, course, flow_session, ordinal):
+    """Return the :class:`course.models.FlowPageData` at *ordinal* in
+    *flow_session*, creating it if it has not been created yet. The created
+    page data only depends on the session and *ordinal*.
+
+    :raises: :exc:`course.models.FlowPageData.DoesNotExist` if *ordinal* is
+        out of range.
+    """
+
+    from course.models import FlowPageData
+
+    try:
+        return FlowPageData.objects.get(
+                flow_session=flow_session, ordinal=ordinal)
+    except FlowPageData.DoesNotExist:
+        if not (0 <= ordinal < flow_session.page_count):
+            raise
+
+    data = _make_lazy_flow_page_data(repo, course, flow_session, ordinal)
+
+    from django.db import transaction, IntegrityError
+    try:
+        with transaction.atomic():
             data.save()
+    except IntegrityError:
+        # created concurrently
+        return FlowPageData.objects.get(
+                flow_session=flow_session, ordinal=ordinal)
+
+    return data
+
+
+def materialize_flow_session_page_data(repo, course, flow_session):
+    """Make sure that :class:`course.models.FlowPageData` exists for all
+    pages of *flow_session*.
+    """
+
+    from course.models import FlowPageData
+
+    existing_ordinals = set(
+            FlowPageData.objects
+            .filter(flow_session=flow_session)
+            .values_list("ordinal", flat=True))
+
+    missing_ordinals = [
+            ordinal for ordinal in range(flow_session.page_count)
+            if ordinal not in existing_ordinals]
 
-            ordinal += 1
+    if not missing_ordinals:
+        return
+
+    all_page_data = [
+            _make_lazy_flow_page_data(repo, course, flow_session, ordinal)
+            for ordinal in missing_ordinals]
+
+    from django.db import transaction, IntegrityError
+    try:
+        with transaction.atomic():
+            FlowPageData.objects.bulk_create(all_page_data)
+    except IntegrityError:
+        # Some were created concurrently.
+        for ordinal in missing_ordinals:
+            get_flow_session_page_data(repo, course, flow_session, ordinal)
+
+
+def fill_in_flow_session_page_keys(repo, course, flow_session, all_page_data):
+    """Return a list with a :class:`course.models.FlowPageData` for every
+    page of *flow_session*. Pages missing from *all_page_data* (because
+    their page data has not been created yet) are represented by unsaved
+    instances that only have their *ordinal*, *group_id* and *page_id*
+    set. This suits uses that only need to know which page is where,
+    without writing to the database.
+    """
+
+    if len(all_page_data) == flow_session.page_count:
+        return all_page_data
 
-    return ordinal
+    from course.models import FlowPageData
+
+    commit_sha = flow_session.active_git_commit_sha.encode()
+    flow_desc = get_flow_desc(repo, course, flow_session.flow_id, commit_sha)
+
+    existing = dict((data.ordinal, data) for data in all_page_data)
+
+    result = []
+    for ordinal in range(flow_session.page_count):
+        data = existing.get(ordinal)
+        if data is None:
+            data = FlowPageData()
+            data.ordinal = ordinal
+            data.group_id, data.page_id = \
+                    flow_desc.page_keys_by_ordinal[ordinal]
+
+        result.append(data)
+
+    return result
+
+# }}}
 
 
 def get_course_commit_sha(course, participation):
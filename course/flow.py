@@ -39,75 +39,54 @@ from course.models import (
         flow_permission,
         GradeChange)
 
+from course.grading import submit_grading_after_commit
+
 from course.utils import (
         FlowContext, FlowPageContext,
-        instantiate_flow_page_with_ctx)
+        instantiate_flow_page_with_ctx,
+        GradingContext, get_flow_session_grading_context)
 
 
 # {{{ grade page visit
 
-def grade_page_visit(visit, visit_grade_model=FlowPageVisitGrade, grade_data=None):
-    if not visit.is_graded_answer:
-        raise RuntimeError("cannot grade ungraded answer")
-
-    flow_session = visit.flow_session
-    course = flow_session.course
-    page_data = visit.page_data
-
-    from course.content import (
-            get_course_repo,
-            get_course_commit_sha,
-            get_flow_commit_sha,
-            get_flow_desc,
-            get_flow_page_desc,
-            instantiate_flow_page)
-
-    repo = get_course_repo(course)
+def grade_page_visit(visit, visit_grade_model=FlowPageVisitGrade, grade_data=None,
+        grading_context=None):
+    make_page_visit_grade(visit, visit_grade_model, grade_data,
+            grading_context=grading_context).save()
 
-    course_commit_sha = get_course_commit_sha(
-            course, flow_session.participation)
 
-    flow_desc_pre = get_flow_desc(repo, course,
-            flow_session.flow_id, course_commit_sha)
+def make_page_visit_grade(visit, visit_grade_model=FlowPageVisitGrade,
+        grade_data=None, grading_context=None):
+    """Grade *visit* and return the (unsaved) grade.
 
-    flow_commit_sha = get_flow_commit_sha(
-            course, flow_session.participation, flow_desc_pre,
-            visit.flow_session)
+    :arg grading_context: a :class:`course.utils.GradingContext` for the
+        visit's flow session. Pass one when grading many visits of the same
+        session to avoid resolving it for each of them.
+    """
 
-    flow_desc = get_flow_desc(repo, course,
-            flow_session.flow_id, flow_commit_sha)
-
-    page_desc = get_flow_page_desc(
-            flow_session.flow_id,
-            flow_desc,
-            page_data.group_id, page_data.page_id)
+    if not visit.is_graded_answer:
+        raise RuntimeError("cannot grade ungraded answer")
 
-    page = instantiate_flow_page(
-            location="flow '%s', group, '%s', page '%s'"
-            % (flow_session.flow_id, page_data.group_id, page_data.page_id),
-            repo=repo, page_desc=page_desc,
-            commit_sha=flow_commit_sha)
+    if grading_context is None:
+        grading_context = get_flow_session_grading_context(visit.flow_session)
 
-    from course.page import PageContext
-    grading_page_context = PageContext(
-            course=course,
-            repo=repo,
-            commit_sha=flow_commit_sha)
+    page_data = visit.page_data
+    page = grading_context.get_page(page_data.group_id, page_data.page_id)
 
     answer_feedback = page.grade(
-            grading_page_context, visit.page_data.data,
+            grading_context.page_context, page_data.data,
             visit.answer, grade_data=grade_data)
 
     grade = visit_grade_model()
     grade.visit = visit
     grade.grade_data = grade_data
-    grade.max_points = page.max_points(visit.page_data)
+    grade.max_points = page.max_points(page_data)
 
     if answer_feedback is not None:
         grade.correctness = answer_feedback.correctness
         grade.feedback = answer_feedback.as_json()
 
-    grade.save()
+    return grade
 
 # }}}
 
@@ -134,9 +113,13 @@ def assemble_answer_visits(flow_session):
 
     answer_page_visits = (
             get_flow_session_graded_answers_qset(flow_session)
+            .select_related("page_data")
             .order_by("visit_time"))
 
     for page_visit in answer_page_visits:
+        # avoid a query per visit when the session is needed
+        page_visit.flow_session = flow_session
+
         answer_visits[page_visit.page_data.ordinal] = page_visit
 
         if not flow_session.in_progress:
@@ -149,11 +132,31 @@ def assemble_answer_visits(flow_session):
     return answer_visits
 
 
-def count_answered(fctx, flow_session, answer_visits):
-    all_page_data = (FlowPageData.objects
+def get_all_page_data(flow_session):
+    return list(FlowPageData.objects
             .filter(flow_session=flow_session)
             .order_by("ordinal"))
 
+
+def get_most_recent_grades(flow_session):
+    """
+    :returns: a dictionary mapping the IDs of the visits in *flow_session*
+        to their most recent :class:`course.models.FlowPageVisitGrade`.
+    """
+
+    result = {}
+    for grade in (FlowPageVisitGrade.objects
+            .filter(visit__flow_session=flow_session)
+            .order_by("grade_time")):
+        result[grade.visit_id] = grade
+
+    return result
+
+
+def count_answered(fctx, flow_session, answer_visits, all_page_data=None):
+    if all_page_data is None:
+        all_page_data = get_all_page_data(flow_session)
+
     answered_count = 0
     unanswered_count = 0
     for i, page_data in enumerate(all_page_data):
@@ -211,10 +214,11 @@ class GradeInfo(object):
         return 100*self.incorrect_count/self.total_count()
 
 
-def gather_grade_info(fctx, answer_visits):
-    all_page_data = (FlowPageData.objects
-            .filter(flow_session=fctx.flow_session)
-            .order_by("ordinal"))
+def gather_grade_info(flow_session, answer_visits, all_page_data=None):
+    if all_page_data is None:
+        all_page_data = get_all_page_data(flow_session)
+
+    most_recent_grades = get_most_recent_grades(flow_session)
 
     points = 0
     max_points = 0
@@ -229,7 +233,7 @@ def gather_grade_info(fctx, answer_visits):
             # page did not expect an answer
             continue
 
-        grade = answer_visits[i].get_most_recent_grade()
+        grade = most_recent_grades.get(answer_visits[i].pk)
         assert grade is not None
 
         from course.page import AnswerFeedback
@@ -256,70 +260,142 @@ def gather_grade_info(fctx, answer_visits):
             incorrect_count=incorrect_count)
 
 
-def grade_page_visits(fctx, flow_session, answer_visits):
-    for i in range(len(answer_visits)):
-        answer_visit = answer_visits[i]
+def grade_page_visits(fctx, flow_session, answer_visits, all_page_data=None,
+        allow_deferral=False):
+    """
+    :arg allow_deferral: if *True*, answers on pages whose grading is
+        expensive are left ungraded, or keep their existing grade.
+    :returns: *True* if grading of some answers was deferred.
+    """
+
+    if all_page_data is None:
+        all_page_data = get_all_page_data(flow_session)
+
+    # {{{ mark existing answers as graded
+
+    existing_visits = [visit for visit in answer_visits if visit is not None]
+
+    FlowPageVisit.objects.filter(
+            pk__in=[visit.pk for visit in existing_visits]).update(
+                    is_graded_answer=True)
+
+    for visit in existing_visits:
+        visit.is_graded_answer = True
+
+    # }}}
 
-        if answer_visit is not None:
-            answer_visit.is_graded_answer = True
-            answer_visit.save()
+    # {{{ create synthetic visits to attach grades to
 
+    from django.utils.timezone import now
+    synthetic_visit_time = now()
+
+    synthetic_visits = []
+    for i, page_data in enumerate(all_page_data):
+        if answer_visits[i] is not None:
+            continue
+
+        page = instantiate_flow_page_with_ctx(fctx, page_data)
+        if not page.expects_answer():
+            continue
+
+        answer_visit = FlowPageVisit()
+        answer_visit.flow_session = flow_session
+        answer_visit.page_data = page_data
+        answer_visit.visit_time = synthetic_visit_time
+        answer_visit.is_synthetic = True
+        answer_visit.answer = None
+        answer_visit.is_graded_answer = True
+        synthetic_visits.append(answer_visit)
+
+    if synthetic_visits:
+        FlowPageVisit.objects.bulk_create(synthetic_visits)
+
+        if all(answer_visit.pk is not None
+                for answer_visit in synthetic_visits):
+            # The database backend reported the IDs.
+            created_visits = synthetic_visits
         else:
-            page_data = flow_session.page_data.get(ordinal=i)
-            page = instantiate_flow_page_with_ctx(fctx, page_data)
+            # Re-read to obtain their IDs. Only the pages given synthetic
+            # visits above are queried, and each gets its newest synthetic
+            # graded visit.
+            page_data_by_id = dict(
+                    (answer_visit.page_data.pk, answer_visit.page_data)
+                    for answer_visit in synthetic_visits)
+
+            created_visits = list(FlowPageVisit.objects
+                    .filter(
+                        flow_session=flow_session,
+                        page_data__in=list(page_data_by_id),
+                        is_synthetic=True,
+                        is_graded_answer=True)
+                    .order_by("pk"))
+
+            for answer_visit in created_visits:
+                answer_visit.flow_session = flow_session
+                answer_visit.page_data = \
+                        page_data_by_id[answer_visit.page_data_id]
+
+        for answer_visit in created_visits:
+            answer_visits[answer_visit.page_data.ordinal] = answer_visit
 
-            if not page.expects_answer():
-                continue
+    # }}}
 
-            # Create a synthetic visit to attach a grade
-            answer_visit = FlowPageVisit()
-            answer_visit.flow_session = flow_session
-            answer_visit.page_data = page_data
-            answer_visit.is_synthetic = True
-            answer_visit.answer = None
-            answer_visit.is_graded_answer = True
-            answer_visit.save()
+    grading_context = GradingContext(fctx.course, fctx.repo,
+            fctx.flow_identifier, fctx.flow_commit_sha)
 
-            answer_visits[i] = answer_visit
+    grades = []
+    deferred = False
 
-        if answer_visit is not None:
-            grade_page_visit(answer_visit)
+    if allow_deferral:
+        graded_visit_ids = set(get_most_recent_grades(flow_session))
 
+    for answer_visit in answer_visits:
+        if answer_visit is None:
+            continue
 
-def finish_flow_session(fctx, flow_session):
-    if not flow_session.in_progress:
-        raise RuntimeError("Can't end a session that's already ended")
+        if allow_deferral:
+            page_data = answer_visit.page_data
+            page = grading_context.get_page(page_data.group_id, page_data.page_id)
+            # Missing answers are cheap to grade, whatever the page.
+            if page.grading_is_expensive and answer_visit.answer is not None:
+                # An existing grade (e.g. from when the answer was
+                # submitted) is kept rather than recomputed.
+                if answer_visit.pk not in graded_visit_ids:
+                    deferred = True
+                continue
 
-    answer_visits = assemble_answer_visits(flow_session)
+        grades.append(
+                make_page_visit_grade(
+                    answer_visit, grading_context=grading_context))
 
-    (answered_count, unanswered_count) = count_answered(
-            fctx, fctx.flow_session, answer_visits)
+    FlowPageVisitGrade.objects.bulk_create(grades)
 
-    is_graded_flow = bool(answered_count + unanswered_count)
+    return deferred
 
-    if is_graded_flow:
-        grade_page_visits(fctx, flow_session, answer_visits)
+
+def finalize_flow_session_grade(flow_session, flow_desc, answer_visits,
+        all_page_data, is_graded_flow):
+    """Fill in the points of *flow_session* (which must be finished and have
+    all its answers graded) and record the corresponding
+    :class:`course.models.GradeChange`.
+    """
 
     # ORDERING RESTRICTION: Must grade pages before gathering grade info
 
-    grade_info = gather_grade_info(fctx, answer_visits)
+    grade_info = gather_grade_info(flow_session, answer_visits, all_page_data)
 
     comment = None
 
     if grade_info is not None:
         points = grade_info.points
 
-        if hasattr(fctx.stipulations, "credit_percent"):
+        if flow_session.credit_percent is not None:
             comment = "Counted at %.1f%% of %.1f points" % (
-                    fctx.stipulations.credit_percent, points)
-            points = points * fctx.stipulations.credit_percent / 100
+                    flow_session.credit_percent, points)
+            points = points * flow_session.credit_percent / 100
     else:
         points = None
 
-    from django.utils.timezone import now
-    flow_session.completion_time = now()
-    flow_session.in_progress = False
-
     if grade_info is not None:
         flow_session.points = points
         flow_session.max_points = grade_info.max_points
@@ -328,17 +404,21 @@ def finish_flow_session(fctx, flow_session):
         flow_session.max_points = None
 
     flow_session.result_comment = comment
+    flow_session.grading_pending = False
+    flow_session.grading_lease_expiry = None
     flow_session.save()
 
-    if is_graded_flow and fctx.participation is not None and grade_info is not None:
+    participation = flow_session.participation
+
+    if is_graded_flow and participation is not None and grade_info is not None:
         from course.models import get_flow_grading_opportunity
         gopp = get_flow_grading_opportunity(
-                fctx.course, fctx.flow_identifier, fctx.flow_desc)
+                flow_session.course, flow_session.flow_id, flow_desc)
 
         from course.models import grade_state_change_types
         gchange = GradeChange()
         gchange.opportunity = gopp
-        gchange.participation = fctx.participation
+        gchange.participation = participation
         gchange.state = grade_state_change_types.graded
         gchange.points = points
         gchange.max_points = grade_info.max_points
@@ -349,6 +429,57 @@ def finish_flow_session(fctx, flow_session):
 
     return grade_info
 
+
+def finish_flow_session(fctx, flow_session):
+    """
+    :returns: a :class:`GradeInfo`, or *None* if no grade is available
+        (yet). If grading was deferred, *flow_session.grading_pending*
+        is set.
+    """
+
+    if not flow_session.in_progress:
+        raise RuntimeError("Can't end a session that's already ended")
+
+    from course.content import materialize_flow_session_page_data
+    materialize_flow_session_page_data(fctx.repo, fctx.course, flow_session)
+
+    answer_visits = assemble_answer_visits(flow_session)
+    all_page_data = get_all_page_data(flow_session)
+
+    (answered_count, unanswered_count) = count_answered(
+            fctx, fctx.flow_session, answer_visits, all_page_data)
+
+    is_graded_flow = bool(answered_count + unanswered_count)
+
+    from course.grading import is_deferred_grading_enabled
+
+    grading_deferred = False
+    if is_graded_flow:
+        grading_deferred = grade_page_visits(
+                fctx, flow_session, answer_visits, all_page_data,
+                allow_deferral=is_deferred_grading_enabled())
+
+    from django.utils.timezone import now
+    flow_session.completion_time = now()
+    flow_session.in_progress = False
+    flow_session.credit_percent = getattr(
+            fctx.stipulations, "credit_percent", None)
+
+    if grading_deferred:
+        flow_session.points = None
+        flow_session.max_points = None
+        flow_session.result_comment = None
+        flow_session.grading_pending = True
+        flow_session.save()
+
+        from course.grading import enqueue_deferred_grading
+        enqueue_deferred_grading(flow_session.id)
+
+        return None
+
+    return finalize_flow_session_grade(flow_session, fctx.flow_desc,
+            answer_visits, all_page_data, is_graded_flow)
+
 # }}}
 
 
@@ -438,14 +569,12 @@ def start_flow(request, course_identifier, flow_identifier):
             session.flow_id = flow_identifier
             session.in_progress = True
             session.for_credit = "start_credit" in request.POST
-            session.save()
 
-            request.session["flow_session_id"] = session.id
-
-            page_count = set_up_flow_session_page_data(fctx.repo, session,
+            # saves the session
+            set_up_flow_session_page_data(fctx.repo, session,
                     course_identifier, fctx.flow_desc, fctx.flow_commit_sha)
-            session.page_count = page_count
-            session.save()
+
+            request.session["flow_session_id"] = session.id
 
             return redirect("course.flow.view_flow_page",
                     course_identifier,
@@ -765,10 +894,33 @@ def view_flow_page(request, course_identifier, flow_identifier, ordinal):
 
 # {{{ view: finish flow
 
+def find_grading_pending_flow_session(request, flow_identifier):
+    """Find a flow session that was finished in this (browser) session, but
+    whose grading was deferred. It remains findable until its grade has been
+    shown.
+    """
+
+    flow_session = None
+    flow_session_id = request.session.get("grading_pending_flow_session_id")
+
+    if flow_session_id is not None:
+        flow_sessions = list(FlowSession.objects.filter(id=flow_session_id))
+
+        if flow_sessions and flow_sessions[0].flow_id == flow_identifier:
+            flow_session, = flow_sessions
+
+    return flow_session
+
+
+@submit_grading_after_commit
 @transaction.atomic
 def finish_flow_session_view(request, course_identifier, flow_identifier):
     flow_session = find_current_flow_session(request, flow_identifier)
 
+    if flow_session is None:
+        flow_session = find_grading_pending_flow_session(
+                request, flow_identifier)
+
     if flow_session is None:
         messages.add_message(request, messages.WARNING,
                 "No session record found for this flow. "
@@ -788,8 +940,15 @@ def finish_flow_session_view(request, course_identifier, flow_identifier):
             fctx.course, fctx.repo, fctx.flow_commit_sha,
             fctx.flow_desc.completion_text)
 
+    # Lazily created page data is only materialized when the session is
+    # actually finished (see finish_flow_session), not on viewing this page.
+    from course.content import fill_in_flow_session_page_keys
+    all_page_data = fill_in_flow_session_page_keys(
+            fctx.repo, fctx.course, flow_session,
+            get_all_page_data(flow_session))
+
     (answered_count, unanswered_count) = count_answered(
-            fctx, fctx.flow_session, answer_visits)
+            fctx, fctx.flow_session, answer_visits, all_page_data)
 
     def render_finish_response(template, **kwargs):
         render_args = {
@@ -818,6 +977,13 @@ def finish_flow_session_view(request, course_identifier, flow_identifier):
 
         grade_info = finish_flow_session(fctx, flow_session)
 
+        if flow_session.grading_pending:
+            request.session["grading_pending_flow_session_id"] = flow_session.id
+
+            return render_finish_response(
+                    "course/flow-completion-pending.html",
+                    completion_text=completion_text)
+
         if answered_count + unanswered_count:
             # This is a graded flow.
 
@@ -857,8 +1023,17 @@ def finish_flow_session_view(request, course_identifier, flow_identifier):
                 completion_text=completion_text)
 
     elif not flow_session.in_progress:
+        if flow_session.grading_pending:
+            return render_finish_response(
+                    "course/flow-completion-pending.html",
+                    completion_text=completion_text)
+
+        if (request.session.get("grading_pending_flow_session_id")
+                == flow_session.id):
+            request.session["grading_pending_flow_session_id"] = None
+
         # Just reviewing: re-show grades.
-        grade_info = gather_grade_info(fctx, answer_visits)
+        grade_info = gather_grade_info(flow_session, answer_visits)
 
         return render_finish_response(
                 "course/flow-completion-grade.html",
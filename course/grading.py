@@ -0,0 +1,794 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2014 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+__doc__ = """
+Deferred grading
+----------------
+
+When a flow session is finished, answers on pages whose grading is expensive
+(see :attr:`course.page.PageBase.grading_is_expensive`) are not graded within
+the request. Instead, the session is marked as
+:attr:`course.models.FlowSession.grading_pending` and grading is handed to a
+pool of worker threads in the server process. Once all answers are graded,
+the session's points and the corresponding
+:class:`course.models.GradeChange` are filled in.
+
+Alternatively, deferred grading can be queued durably in the database as
+:class:`course.models.GradingJob` instances, one per answer. These are
+processed by workers started with::
+
+    python manage.py run_grading_worker --processes=4
+
+which may run on other machines than the web server. Jobs survive restarts
+and are retried when grading fails. Jobs have priorities, so that answers
+from finished sessions are graded before bulk regrades (see
+:func:`enqueue_regrade`). Workers claim the jobs for answers to one question
+in batches and run the code in these answers in one container (see
+:func:`claim_grading_jobs`).
+
+Answers whose grading fails for good receive a grade without correctness
+(so that they show up as needing manual grading), and the session's
+grading is completed without points. Failed jobs can be requeued from the
+admin interface, after which the session's grade is recomputed. Grading
+that was interrupted, e.g. by a restart of the server process, is resumed
+by::
+
+    python manage.py resume_deferred_grading
+
+Settings:
+
+* ``CF_DEFERRED_GRADING``: whether to defer grading as described.
+  Defaults to *False*.
+* ``CF_GRADING_QUEUE``: ``"threads"`` (the default) to grade in worker
+  threads of the server process, or ``"database"`` to queue
+  :class:`course.models.GradingJob` instances.
+* ``CF_DEFERRED_GRADING_THREADS``: number of worker threads per server
+  process. Defaults to 2.
+* ``CF_GRADING_JOB_MAX_ATTEMPTS``: number of times a grading job is tried
+  before it is marked as failed. Defaults to 3.
+* ``CF_GRADING_JOB_TIMEOUT``: number of seconds after which a running job
+  is assumed to belong to a dead worker and is queued again. Defaults to
+  600. A flow session whose grading a server process has started is
+  likewise left alone by other processes for this long.
+* ``CF_GRADING_JOB_BATCH_SIZE``: the maximum number of jobs a worker
+  claims at a time. Defaults to 50. All of them must be graded within
+  ``CF_GRADING_JOB_TIMEOUT``.
+"""
+
+from django.conf import settings
+from django.db import transaction
+
+import threading
+import sys
+
+
+def is_deferred_grading_enabled():
+    return getattr(settings, "CF_DEFERRED_GRADING", False)
+
+
+def _uses_database_queue():
+    queue = getattr(settings, "CF_GRADING_QUEUE", "threads")
+    if queue not in ["threads", "database"]:
+        raise ValueError("invalid value of CF_GRADING_QUEUE: '%s'" % queue)
+
+    return queue == "database"
+
+
+# {{{ worker pool
+
+_POOL_LOCK = threading.Lock()
+_JOB_QUEUE = None
+
+
+def _run_worker(job_queue):
+    from django.db import connection
+
+    while True:
+        job, args = job_queue.get()
+
+        try:
+            job(*args)
+        except Exception:
+            _log_grading_failure("deferred grading job failed")
+        finally:
+            # Each worker thread has its own connection.
+            connection.close()
+
+
+def _submit_job(job, *args):
+    global _JOB_QUEUE
+
+    with _POOL_LOCK:
+        if _JOB_QUEUE is None:
+            from Queue import Queue
+            _JOB_QUEUE = Queue()
+
+            for i in range(getattr(settings, "CF_DEFERRED_GRADING_THREADS", 2)):
+                worker = threading.Thread(
+                        target=_run_worker, args=(_JOB_QUEUE,),
+                        name="deferred-grading-%d" % i)
+                worker.daemon = True
+                worker.start()
+
+    _JOB_QUEUE.put((job, args))
+
+# }}}
+
+
+# {{{ submission after commit
+
+# Jobs must not start before the transaction that created the data they work
+# on has been committed. While a view decorated with
+# :func:`submit_grading_after_commit` runs, jobs are collected here.
+
+_PENDING = threading.local()
+
+
+def enqueue_deferred_grading(flow_session_id):
+    """Arrange for the pending grading of the flow session with ID
+    *flow_session_id* to be completed by a worker.
+
+    If called outside of a view decorated with
+    :func:`submit_grading_after_commit`, the caller must ensure that the
+    session has been committed to the database, unless the database queue
+    is in use.
+    """
+
+    if _uses_database_queue():
+        # The jobs become visible to workers when the current transaction
+        # commits.
+        from course.models import FlowPageVisit, grading_job_priority
+        jobs = enqueue_grading_jobs(
+                FlowPageVisit.objects.filter(
+                    flow_session=flow_session_id,
+                    is_graded_answer=True,
+                    grades__isnull=True),
+                priority=grading_job_priority.interactive)
+
+        if not jobs:
+            # No job will ever complete the session's grading.
+            grade_deferred_flow_session(flow_session_id)
+
+        return
+
+    pending = getattr(_PENDING, "flow_session_ids", None)
+    if pending is not None:
+        pending.append(flow_session_id)
+    else:
+        _submit_job(grade_deferred_flow_session, flow_session_id)
+
+
+def submit_grading_after_commit(view_func):
+    """Decorator for views that finish flow sessions. Must be applied
+    outside of (i.e. above) :func:`django.db.transaction.atomic`.
+    """
+
+    def wrapper(*args, **kwargs):
+        outer_pending = getattr(_PENDING, "flow_session_ids", None)
+        _PENDING.flow_session_ids = []
+
+        try:
+            result = view_func(*args, **kwargs)
+            pending = _PENDING.flow_session_ids
+        finally:
+            _PENDING.flow_session_ids = outer_pending
+
+        for flow_session_id in pending:
+            enqueue_deferred_grading(flow_session_id)
+
+        return result
+
+    from functools import update_wrapper
+    update_wrapper(wrapper, view_func)
+
+    return wrapper
+
+# }}}
+
+
+# {{{ grading job
+
+GRADING_FAILED_FEEDBACK = (
+        "Your answer could not be graded automatically. "
+        "It will be graded by the course staff.")
+GRADING_FAILED_COMMENT = (
+        "Automatic grading failed for some answers, "
+        "which need to be graded manually.")
+
+
+def make_failed_grade(visit, grading_context=None):
+    """Return an (unsaved) grade for *visit* recording that automatic
+    grading failed. Its correctness is *None*, so that no points are
+    computed for the session until the answer is graded manually.
+    """
+
+    from course.models import FlowPageVisitGrade
+    from course.page import AnswerFeedback
+
+    max_points = None
+    if grading_context is not None:
+        try:
+            page_data = visit.page_data
+            page = grading_context.get_page(
+                    page_data.group_id, page_data.page_id)
+            max_points = page.max_points(page_data)
+        except Exception:
+            pass
+
+    grade = FlowPageVisitGrade()
+    grade.visit = visit
+    grade.max_points = max_points
+    grade.correctness = None
+    grade.feedback = AnswerFeedback(
+            correctness=None, correct_answer="",
+            feedback=GRADING_FAILED_FEEDBACK).as_json()
+
+    return grade
+
+
+def _log_grading_failure(what):
+    from traceback import format_exc
+    sys.stderr.write("%s:\n%s" % (what, format_exc()))
+
+
+def abandon_deferred_grading(flow_session_id):
+    """Mark the pending grading of the flow session with ID
+    *flow_session_id* as finished without a grade, so that it does not stay
+    pending forever.
+    """
+
+    from course.models import FlowSession
+
+    with transaction.atomic():
+        flow_session = (FlowSession.objects
+                .select_for_update()
+                .get(pk=flow_session_id))
+        if not flow_session.grading_pending:
+            return
+
+        flow_session.points = None
+        flow_session.max_points = None
+        flow_session.result_comment = GRADING_FAILED_COMMENT
+        flow_session.grading_pending = False
+        flow_session.grading_lease_expiry = None
+        flow_session.save()
+
+
+def _prefetch_code_runs(visits_and_contexts):
+    """Run the code in those of *visits_and_contexts*, a list of tuples
+    *(visit, grading_context)*, that answer code questions in batches, one
+    per question (see :func:`course.page.prefetch_python_runs`), rather than
+    one run (and container) at a time.
+    """
+
+    runs = []
+    for visit, grading_context in visits_and_contexts:
+        if visit.answer is None:
+            continue
+
+        page_data = visit.page_data
+        page = grading_context.get_page(page_data.group_id, page_data.page_id)
+        if hasattr(page, "make_run_request"):
+            runs.append(page.make_run_request(visit.answer))
+
+    if len(runs) > 1:
+        from course.page import prefetch_python_runs
+        prefetch_python_runs(runs)
+
+
+def _get_grading_lease_time():
+    from datetime import timedelta
+    return timedelta(
+            seconds=getattr(settings, "CF_GRADING_JOB_TIMEOUT", 600))
+
+
+def _claim_deferred_grading(flow_session_id):
+    """Take the lease on the pending grading of the flow session with ID
+    *flow_session_id*.
+
+    :returns: *False* if grading is no longer pending or if another process
+        holds an unexpired lease on it.
+    """
+
+    from course.models import FlowSession
+    from django.db.models import Q
+    from django.utils.timezone import now
+
+    now_datetime = now()
+
+    # A conditional update, so that only one process can take the lease.
+    return bool(FlowSession.objects
+            .filter(pk=flow_session_id, grading_pending=True)
+            .filter(
+                Q(grading_lease_expiry__isnull=True)
+                | Q(grading_lease_expiry__lt=now_datetime))
+            .update(
+                grading_lease_expiry=now_datetime + _get_grading_lease_time()))
+
+
+def grade_deferred_flow_session(flow_session_id):
+    if not _claim_deferred_grading(flow_session_id):
+        return
+
+    try:
+        _grade_deferred_flow_session(flow_session_id)
+    except Exception:
+        _log_grading_failure(
+                "deferred grading of flow session %d failed"
+                % flow_session_id)
+        abandon_deferred_grading(flow_session_id)
+
+
+def _grade_deferred_flow_session(flow_session_id):
+    from course.models import FlowSession, FlowPageVisitGrade
+    from course.utils import get_flow_session_grading_context
+    from course.flow import (
+            assemble_answer_visits, get_all_page_data, get_most_recent_grades,
+            make_page_visit_grade, finalize_flow_session_grade)
+
+    flow_session = FlowSession.objects.get(pk=flow_session_id)
+    if not flow_session.grading_pending:
+        return
+
+    grading_context = get_flow_session_grading_context(flow_session)
+
+    # Grade outside of a transaction, since this may take a long time.
+
+    answer_visits = assemble_answer_visits(flow_session)
+    graded_visit_ids = set(get_most_recent_grades(flow_session))
+
+    visits_to_grade = [
+            visit for visit in answer_visits
+            if visit is not None and visit.pk not in graded_visit_ids]
+
+    grades = []
+    any_failed = False
+
+    try:
+        _prefetch_code_runs(
+                [(visit, grading_context) for visit in visits_to_grade])
+
+        for visit in visits_to_grade:
+            try:
+                grades.append(
+                        make_page_visit_grade(
+                            visit, grading_context=grading_context))
+            except Exception:
+                _log_grading_failure("grading visit %d failed" % visit.pk)
+                grades.append(make_failed_grade(visit, grading_context))
+                any_failed = True
+    finally:
+        from course.page import clear_prefetched_python_runs
+        clear_prefetched_python_runs()
+
+    with transaction.atomic():
+        flow_session = (FlowSession.objects
+                .select_for_update()
+                .get(pk=flow_session_id))
+        if not flow_session.grading_pending:
+            return
+
+        FlowPageVisitGrade.objects.bulk_create(grades)
+
+        finalize_flow_session_grade(flow_session, grading_context.flow_desc,
+                answer_visits, get_all_page_data(flow_session),
+                is_graded_flow=True)
+
+        if any_failed:
+            flow_session.result_comment = GRADING_FAILED_COMMENT
+            flow_session.save()
+
+
+def resume_deferred_grading():
+    """Arrange for the grading of all flow sessions whose grading is pending
+    but not (or no longer) under way to be completed. In the server process
+    threads configuration, grading happens right here, except for sessions
+    that a server process is still grading (as recorded by
+    :attr:`course.models.FlowSession.grading_lease_expiry`).
+
+    :returns: the number of affected flow sessions.
+    """
+
+    from course.models import FlowSession, GradingJob, grading_job_state
+    from django.db.models import Q
+    from django.utils.timezone import now
+
+    flow_session_ids = list(FlowSession.objects
+            .filter(grading_pending=True, in_progress=False)
+            .filter(
+                Q(grading_lease_expiry__isnull=True)
+                | Q(grading_lease_expiry__lt=now()))
+            .values_list("id", flat=True))
+
+    count = 0
+    for flow_session_id in flow_session_ids:
+        if _uses_database_queue():
+            with transaction.atomic():
+                if (GradingJob.objects
+                        .filter(
+                            flow_session=flow_session_id,
+                            state__in=[
+                                grading_job_state.queued,
+                                grading_job_state.running])
+                        .exists()):
+                    continue
+
+                enqueue_deferred_grading(flow_session_id)
+        else:
+            grade_deferred_flow_session(flow_session_id)
+
+        count += 1
+
+    return count
+
+# }}}
+
+
+# {{{ database queue
+
+def enqueue_grading_jobs(visits, priority=None):
+    """Queue a :class:`course.models.GradingJob` for each visit in *visits*,
+    to be processed by ``run_grading_worker``. The visits must be graded
+    answers.
+
+    :arg priority: defaults to
+        :attr:`course.models.grading_job_priority.bulk`.
+    :returns: the list of (unsaved) jobs.
+    """
+
+    from course.models import GradingJob, grading_job_priority
+
+    if priority is None:
+        priority = grading_job_priority.bulk
+
+    jobs = [
+            GradingJob(
+                flow_session_id=visit.flow_session_id,
+                visit=visit,
+                priority=priority)
+            for visit in visits]
+
+    GradingJob.objects.bulk_create(jobs)
+
+    return jobs
+
+
+def enqueue_regrade(flow_sessions):
+    """Queue jobs to grade all graded answers in *flow_sessions* (such as
+    all sessions of a whole class on one flow) again, at
+    :attr:`course.models.grading_job_priority.bulk`. The grading of the
+    affected sessions is marked as pending, so that their grades are
+    recomputed once the jobs are done. Workers grade answers to the same
+    question in batches (see :func:`claim_grading_jobs`).
+
+    Sessions that are still in progress are skipped. Requires
+    ``CF_GRADING_QUEUE`` to be ``"database"``.
+
+    :returns: the list of (unsaved) jobs.
+    """
+
+    if not _uses_database_queue():
+        raise ValueError("regrading requires CF_GRADING_QUEUE to be "
+                "'database'")
+
+    from course.models import FlowSession
+    from course.flow import assemble_answer_visits
+
+    with transaction.atomic():
+        flow_sessions = list(FlowSession.objects
+                .select_for_update()
+                .filter(
+                    id__in=[flow_session.id for flow_session in flow_sessions],
+                    in_progress=False))
+
+        visits = []
+        for flow_session in flow_sessions:
+            visits.extend(
+                    visit for visit in assemble_answer_visits(flow_session)
+                    if visit is not None)
+
+        # Sessions without answers have no job to complete their grading.
+        (FlowSession.objects
+                .filter(id__in=set(visit.flow_session_id for visit in visits))
+                .update(grading_pending=True))
+
+        return enqueue_grading_jobs(visits)
+
+
+def claim_grading_job(worker_id):
+    """Find the most urgent queued job and mark it as running on
+    *worker_id*.
+
+    :returns: the claimed :class:`course.models.GradingJob`, or *None* if no
+        job is queued.
+    """
+
+    from course.models import GradingJob, grading_job_state
+    from django.db.models import F
+    from django.utils.timezone import now
+    from datetime import timedelta
+
+    now_datetime = now()
+
+    # Re-queue jobs whose worker has presumably died.
+    (GradingJob.objects
+            .filter(
+                state=grading_job_state.running,
+                start_time__lt=now_datetime - timedelta(
+                    seconds=getattr(settings, "CF_GRADING_JOB_TIMEOUT", 600)))
+            .update(state=grading_job_state.queued, worker=None))
+
+    while True:
+        candidate_ids = list(GradingJob.objects
+                .filter(state=grading_job_state.queued)
+                .order_by("-priority", "creation_time")
+                .values_list("id", flat=True)[:10])
+
+        if not candidate_ids:
+            return None
+
+        for job_id in candidate_ids:
+            # Claim by conditional update, so that no two workers can claim
+            # the same job. This works the same on all databases.
+            claimed = (GradingJob.objects
+                    .filter(id=job_id, state=grading_job_state.queued)
+                    .update(
+                        state=grading_job_state.running,
+                        worker=worker_id,
+                        start_time=now_datetime,
+                        attempts=F("attempts") + 1))
+
+            if claimed:
+                return (GradingJob.objects
+                        .select_related(
+                            "flow_session", "visit", "visit__page_data")
+                        .get(id=job_id))
+
+
+def claim_grading_jobs(worker_id, max_count=None):
+    """Claim the most urgent queued job as :func:`claim_grading_job` does,
+    along with further queued jobs of the same priority that grade answers
+    to the same question of the same flow, so that code in these answers
+    can be run as one batch.
+
+    :arg max_count: the maximum number of jobs to claim. Defaults to
+        ``CF_GRADING_JOB_BATCH_SIZE``.
+    :returns: a list of the claimed :class:`course.models.GradingJob`
+        instances, empty if no job is queued.
+    """
+
+    from course.models import GradingJob, grading_job_state
+    from django.db.models import F
+
+    if max_count is None:
+        max_count = getattr(settings, "CF_GRADING_JOB_BATCH_SIZE", 50)
+
+    first_job = claim_grading_job(worker_id)
+    if first_job is None:
+        return []
+
+    if max_count <= 1:
+        return [first_job]
+
+    page_data = first_job.visit.page_data
+    candidate_ids = list(GradingJob.objects
+            .filter(
+                state=grading_job_state.queued,
+                priority=first_job.priority,
+                flow_session__course=first_job.flow_session.course_id,
+                flow_session__flow_id=first_job.flow_session.flow_id,
+                visit__page_data__group_id=page_data.group_id,
+                visit__page_data__page_id=page_data.page_id)
+            .order_by("creation_time")
+            .values_list("id", flat=True)[:max_count-1])
+
+    if not candidate_ids:
+        return [first_job]
+
+    # As in claim_grading_job, the condition on the state keeps jobs that
+    # another worker has claimed in the meantime from being claimed again.
+    (GradingJob.objects
+            .filter(id__in=candidate_ids, state=grading_job_state.queued)
+            .update(
+                state=grading_job_state.running,
+                worker=worker_id,
+                start_time=first_job.start_time,
+                attempts=F("attempts") + 1))
+
+    return [first_job] + list(GradingJob.objects
+            .filter(
+                id__in=candidate_ids,
+                state=grading_job_state.running,
+                worker=worker_id,
+                start_time=first_job.start_time)
+            .select_related("flow_session", "visit", "visit__page_data")
+            .order_by("creation_time"))
+
+
+def _prefetch_grading_job_runs(jobs):
+    from course.utils import get_flow_session_grading_context
+
+    visits_and_contexts = []
+    for job in jobs:
+        try:
+            grading_context = get_flow_session_grading_context(
+                    job.flow_session)
+        except Exception:
+            # run_grading_job will record the failure.
+            continue
+
+        visits_and_contexts.append((job.visit, grading_context))
+
+    _prefetch_code_runs(visits_and_contexts)
+
+
+def run_grading_job(job):
+    """Grade the visit of *job* (which must have been claimed) and, if
+    that was the last outstanding job of a session whose grading is pending,
+    fill in the session's grade.
+
+    If grading fails and the job has used up its attempts
+    (``CF_GRADING_JOB_MAX_ATTEMPTS``), the job is marked as failed, and
+    the answer receives a grade from :func:`make_failed_grade`.
+
+    :returns: *True* if grading succeeded.
+    """
+
+    from course.models import (
+            FlowSession, FlowPageVisit, GradingJob, grading_job_state)
+    from course.utils import get_flow_session_grading_context
+    from course.flow import (
+            assemble_answer_visits, get_all_page_data,
+            make_page_visit_grade, finalize_flow_session_grade)
+    from django.utils.timezone import now
+
+    visit = job.visit
+    visit.flow_session = job.flow_session
+
+    grading_context = None
+    try:
+        grading_context = get_flow_session_grading_context(job.flow_session)
+        grade = make_page_visit_grade(visit, grading_context=grading_context)
+    except Exception:
+        from traceback import format_exc
+        error = format_exc()
+
+        if job.attempts < getattr(settings, "CF_GRADING_JOB_MAX_ATTEMPTS", 3):
+            (GradingJob.objects
+                    .filter(id=job.id)
+                    .update(
+                        state=grading_job_state.queued,
+                        error=error,
+                        completion_time=now()))
+            return False
+
+        grade = make_failed_grade(visit, grading_context)
+        new_state = grading_job_state.failed
+    else:
+        error = None
+        new_state = grading_job_state.done
+
+    with transaction.atomic():
+        # Serializes completion of the jobs of one session, so that exactly
+        # one of them sees the last answer graded.
+        flow_session = (FlowSession.objects
+                .select_for_update()
+                .get(id=job.flow_session_id))
+
+        grade.save()
+
+        (GradingJob.objects
+                .filter(id=job.id)
+                .update(
+                    state=new_state,
+                    error=error,
+                    completion_time=now()))
+
+        if (flow_session.grading_pending
+                and not FlowPageVisit.objects.filter(
+                    flow_session=flow_session,
+                    is_graded_answer=True,
+                    grades__isnull=True).exists()
+                and not GradingJob.objects.filter(
+                    flow_session=flow_session,
+                    state__in=[
+                        grading_job_state.queued,
+                        grading_job_state.running]).exists()):
+            any_failed = GradingJob.objects.filter(
+                    flow_session=flow_session,
+                    state=grading_job_state.failed).exists()
+
+            # If grading failed, the failed grade means that no points are
+            # computed, so that the flow description is not needed.
+            finalize_flow_session_grade(flow_session,
+                    grading_context.flow_desc
+                    if grading_context is not None else None,
+                    assemble_answer_visits(flow_session),
+                    get_all_page_data(flow_session),
+                    is_graded_flow=True)
+
+            if any_failed:
+                flow_session.result_comment = GRADING_FAILED_COMMENT
+                flow_session.save()
+
+    return new_state == grading_job_state.done
+
+
+def requeue_failed_grading_jobs(jobs):
+    """Queue the failed jobs among *jobs* again, with fresh attempts, and
+    mark the grading of their flow sessions as pending, so that the
+    sessions' grades are recomputed once the jobs are done.
+
+    :returns: the number of requeued jobs.
+    """
+
+    from course.models import FlowSession, GradingJob, grading_job_state
+
+    with transaction.atomic():
+        job_ids = [job.id for job in jobs
+                if job.state == grading_job_state.failed]
+
+        (FlowSession.objects
+                .filter(
+                    grading_jobs__id__in=job_ids,
+                    in_progress=False)
+                .update(grading_pending=True))
+
+        return (GradingJob.objects
+                .filter(id__in=job_ids, state=grading_job_state.failed)
+                .update(
+                    state=grading_job_state.queued,
+                    attempts=0,
+                    worker=None,
+                    start_time=None,
+                    completion_time=None))
+
+
+def run_grading_worker(worker_id, poll_interval=2, exit_when_idle=False):
+    from course.page import clear_prefetched_python_runs
+    from time import sleep
+
+    while True:
+        jobs = claim_grading_jobs(worker_id)
+
+        if not jobs:
+            if exit_when_idle:
+                return
+
+            sleep(poll_interval)
+            continue
+
+        try:
+            _prefetch_grading_job_runs(jobs)
+
+            for job in jobs:
+                run_grading_job(job)
+        finally:
+            clear_prefetched_python_runs()
+
+# }}}
+
+# vim: foldmethod=marker
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2014 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    args = "[course_identifier ...]"
+    help = ("Compile content snapshots for the active revision of the given "
+            "courses (default: all courses) that do not have one yet "
+            "(see CF_CONTENT_SNAPSHOT_COMPILE).")
+
+    option_list = BaseCommand.option_list + (
+            make_option("--force", action="store_true", default=False,
+                help="Recompile snapshots that already exist"),
+            )
+
+    def handle(self, *args, **options):
+        from os.path import exists
+
+        from course.models import Course
+        from course.content import get_course_repo, get_course_snapshot_path
+        from course.versioning import compile_course_snapshot_logged
+
+        courses = Course.objects.all()
+        if args:
+            courses = courses.filter(identifier__in=args)
+            missing = set(args) - set(c.identifier for c in courses)
+            if missing:
+                raise CommandError("unknown courses: %s"
+                        % ", ".join(sorted(missing)))
+
+        compiled = 0
+        failed = 0
+        for course in courses:
+            commit_sha = course.active_git_commit_sha.encode()
+            snapshot_path = get_course_snapshot_path(
+                    get_course_repo(course), commit_sha)
+            if exists(snapshot_path) and not options["force"]:
+                continue
+
+            if compile_course_snapshot_logged(course, commit_sha):
+                compiled += 1
+            else:
+                failed += 1
+                self.stderr.write("%s: snapshot could not be compiled"
+                        % course.identifier)
+
+        self.stdout.write("%d snapshots compiled, %d failed."
+                % (compiled, failed))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2014 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+
+def _run_worker_process(poll_interval, exit_when_idle):
+    import os
+    import socket
+    worker_id = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    from course.grading import run_grading_worker
+    run_grading_worker(worker_id, poll_interval=poll_interval,
+            exit_when_idle=exit_when_idle)
+
+
+class Command(BaseCommand):
+    help = ("Process grading jobs queued in the database "
+            "(see CF_GRADING_QUEUE).")
+
+    option_list = BaseCommand.option_list + (
+            make_option("--processes", type="int", default=1,
+                help="Number of worker processes to run (default: 1)"),
+            make_option("--poll-interval", type="float", default=2,
+                help="Seconds to wait before checking an empty queue "
+                "again (default: 2)"),
+            make_option("--exit-when-idle", action="store_true", default=False,
+                help="Exit once the queue is empty"),
+            )
+
+    def handle(self, *args, **options):
+        processes = options["processes"]
+        poll_interval = options["poll_interval"]
+        exit_when_idle = options["exit_when_idle"]
+
+        if processes <= 1:
+            _run_worker_process(poll_interval, exit_when_idle)
+            return
+
+        # Child processes must not share the parent's database connections.
+        from django.db import connections
+        for conn in connections.all():
+            conn.close()
+
+        from multiprocessing import Process
+        workers = [
+                Process(target=_run_worker_process,
+                    args=(poll_interval, exit_when_idle))
+                for i in range(processes)]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
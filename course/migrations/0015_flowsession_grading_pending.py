@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0014_course_events_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowsession',
+            name='grading_pending',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='flowsession',
+            name='credit_percent',
+            field=models.FloatField(help_text=b'Percentage of the achieved points that count, as stipulated when the session was finished.', null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
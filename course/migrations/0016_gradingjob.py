@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0015_flowsession_grading_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradingJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('priority', models.IntegerField(default=0, help_text=b'Jobs with higher priority are run first.')),
+                ('state', models.CharField(default=b'queued', max_length=50, db_index=True, choices=[(b'queued', b'Queued'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('worker', models.CharField(max_length=200, null=True, blank=True)),
+                ('error', models.TextField(null=True, blank=True)),
+                ('creation_time', models.DateTimeField(default=django.utils.timezone.now, db_index=True)),
+                ('start_time', models.DateTimeField(null=True, blank=True)),
+                ('completion_time', models.DateTimeField(null=True, blank=True)),
+                ('flow_session', models.ForeignKey(related_name='grading_jobs', to='course.FlowSession')),
+                ('visit', models.ForeignKey(related_name='grading_jobs', to='course.FlowPageVisit')),
+            ],
+            options={
+                'ordering': ('-priority', 'creation_time'),
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -29,6 +29,8 @@ from django.contrib.auth.models import User
 from django.utils.timezone import now
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 from jsonfield import JSONField
 
@@ -177,6 +179,13 @@ class Event(models.Model):
             return self.kind
 
 
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def _invalidate_event_index(sender, instance, **kwargs):
+    from course.content import invalidate_event_index
+    invalidate_event_index(instance.course_id)
+
+
 # {{{ participation
 
 class participation_role:
@@ -292,6 +301,17 @@ class FlowSession(models.Model):
             blank=True, null=True)
     result_comment = models.TextField(blank=True, null=True)
 
+    # Set when the session was finished with some of its grading deferred
+    # (see course.grading). The fields above are filled in once that
+    # grading completes.
+    grading_pending = models.BooleanField(default=False)
+    # Set while a process works on the pending grading, so that no other
+    # process grades the session at the same time (see course.grading).
+    grading_lease_expiry = models.DateTimeField(null=True, blank=True)
+    credit_percent = models.FloatField(null=True, blank=True,
+            help_text="Percentage of the achieved points that count, "
+            "as stipulated when the session was finished.")
+
     class Meta:
         ordering = ("course", "participation", "-start_time")
 
@@ -598,6 +618,60 @@ class GradeChange(models.Model):
 # }}}
 
 
+# {{{ grading jobs
+
+class grading_job_state:
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+GRADING_JOB_STATE_CHOICES = (
+        (grading_job_state.queued, "Queued"),
+        (grading_job_state.running, "Running"),
+        (grading_job_state.done, "Done"),
+        (grading_job_state.failed, "Failed"),
+        )
+
+
+class grading_job_priority:
+    bulk = 0
+    interactive = 10
+
+
+class GradingJob(models.Model):
+    """A request to grade one :class:`FlowPageVisit`, processed by the
+    ``run_grading_worker`` management command. See :mod:`course.grading`.
+    """
+
+    flow_session = models.ForeignKey(FlowSession, related_name="grading_jobs")
+    visit = models.ForeignKey(FlowPageVisit, related_name="grading_jobs")
+
+    priority = models.IntegerField(default=grading_job_priority.bulk,
+            help_text="Jobs with higher priority are run first.")
+    state = models.CharField(max_length=50, db_index=True,
+            choices=GRADING_JOB_STATE_CHOICES,
+            default=grading_job_state.queued)
+    attempts = models.IntegerField(default=0)
+
+    worker = models.CharField(max_length=200, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    creation_time = models.DateTimeField(default=now, db_index=True)
+    start_time = models.DateTimeField(null=True, blank=True)
+    completion_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ("-priority", "creation_time")
+
+    def __unicode__(self):
+        return "grading job %s for %s (%s)" % (
+                self.id, self.visit, self.state)
+
+# }}}
+
+
 # {{{ grade state machine
 
 class GradeStateMachine(object):
@@ -27,12 +27,14 @@ THE SOFTWARE.
 from course.validation import validate_struct, ValidationError, validate_markup
 from course.content import remove_prefix
 from django.utils.safestring import mark_safe
+from django.conf import settings
 import django.forms as forms
 
-from courseflow.utils import StyledForm
+from courseflow.utils import StyledForm, LRUCache
 
 import re
 import sys
+import threading
 
 
 __doc__ = """
@@ -171,7 +173,14 @@ class PageBase(object):
 
         The page identifier.
 
+    .. attribute:: grading_is_expensive
+
+        Whether grading an answer on this page is expensive (e.g. because
+        it runs code). Grading of such pages may be deferred to a background
+        worker when a flow session is finished, see :mod:`course.grading`.
+
     .. automethod:: make_page_data
+    .. automethod:: make_seeded_page_data
     .. automethod:: title
     .. automethod:: body
     .. automethod:: expects_answer
@@ -182,6 +191,8 @@ class PageBase(object):
     .. automethod:: grade
     """
 
+    grading_is_expensive = False
+
     def __init__(self, vctx, location, id):
         """
         :arg vctx: a :class:`course.validation.ValidationContext`, or None
@@ -200,6 +211,14 @@ class PageBase(object):
         """
         return {}
 
+    def make_seeded_page_data(self, seed):
+        """Like :meth:`make_page_data`, but any randomness should be derived
+        from *seed* (an :class:`int`), so that the same seed always results
+        in the same page data. This is used for flows whose page data is only
+        created when a page is first visited.
+        """
+        return self.make_page_data()
+
     def title(self, page_context, page_data):
         """Return the (non-HTML) title of this page."""
 
@@ -680,14 +699,21 @@ class ChoiceQuestion(PageBase):
     def max_points(self, page_data):
         return self.page_desc.value
 
-    def make_page_data(self):
-        import random
+    def _make_page_data(self, rng):
         perm = range(len(self.page_desc.choices))
         if self.shuffle:
-            random.shuffle(perm)
+            rng.shuffle(perm)
 
         return {"permutation": perm}
 
+    def make_page_data(self):
+        import random
+        return self._make_page_data(random)
+
+    def make_seeded_page_data(self, seed):
+        from random import Random
+        return self._make_page_data(Random(seed))
+
     def make_choice_form(self, page_context, page_data, *args, **kwargs):
         permutation = page_data["permutation"]
 
@@ -792,154 +818,130 @@ class PythonCodeForm(StyledForm):
         pass
 
 
-CFRUNPY_PORT = 9941
+# {{{ code runs
 
+_RUN_RESULT_LRU = LRUCache(
+        getattr(settings, "CF_CODE_RUN_MEMO_SIZE", 1000),
+        max_age=getattr(settings, "CF_CODE_RUN_MEMO_MAX_AGE", 3600))
 
-class InvalidPingResponse(RuntimeError):
-    pass
+# Results that say more about the runner than about the code.
+_UNMEMOIZABLE_RUN_RESULTS = ["uncaught_error", "timeout"]
 
 
-def request_python_run(run_req, run_timeout):
+def _get_run_request_key(run_req, run_timeout):
     import json
-    import httplib
-    from django.conf import settings
-    import docker
-    import socket
-    import errno
-    from httplib import BadStatusLine
-    from docker.errors import APIError as DockerAPIError
-
-    debug = False
-    if debug:
-        def debug_print(s):
-            print s
-    else:
-        def debug_print(s):
-            pass
+    from hashlib import sha256
 
-    docker_timeout = 15
+    return sha256(
+            json.dumps([run_req, run_timeout], sort_keys=True)
+            .encode("utf-8")).hexdigest()
 
-    # DEBUGGING SWITCH: 1 for 'spawn container', 0 for 'static container'
-    if 1:
-        docker_cnx = docker.Client(
-                base_url='unix://var/run/docker.sock',
-                version='1.12', timeout=docker_timeout)
 
-        dresult = docker_cnx.create_container(
-                image=settings.CF_DOCKER_CFRUNPY_IMAGE,
-                command=[
-                    "/opt/cfrunpy/cfrunpy-venv/bin/python",
-                    "/opt/cfrunpy/cfrunpy",
-                    "-1"],
-                mem_limit=256e6,
-                user="cfrunpy")
+# Responses obtained ahead of time by prefetch_python_runs, by
+# _get_run_request_key.
+_PREFETCHED_RUNS = threading.local()
 
-        container_id = dresult["Id"]
-    else:
-        container_id = None
 
-    try:
-        # FIXME: Prohibit networking
+def prefetch_python_runs(runs):
+    """Run the requests in *runs*, a list of tuples *(run_req, run_timeout)*,
+    in batches (see :func:`request_python_run_batch`). The responses are
+    kept for the current thread, where :func:`request_python_run` returns
+    them, until :func:`clear_prefetched_python_runs` is called.
 
-        if container_id is not None:
-            docker_cnx.start(
-                    container_id,
-                    port_bindings={CFRUNPY_PORT: ('127.0.0.1',)})
+    Requests that differ only in their ``user_code`` (such as the answers of
+    a whole class to one question, at one revision of the course) form one
+    batch, whose ``setup_code``, ``test_code`` etc. are sent only once, as
+    its common part. Requests without such company are left to be run
+    individually.
+    """
 
-            port_info, = docker_cnx.port(container_id, CFRUNPY_PORT)
-            port = int(port_info["HostPort"])
-        else:
-            port = CFRUNPY_PORT
+    import json
 
-        from time import time, sleep
-        start_time = time()
+    prefetched = getattr(_PREFETCHED_RUNS, "responses", None)
+    if prefetched is None:
+        prefetched = _PREFETCHED_RUNS.responses = {}
 
-        # {{{ ping until response received
+    batches = {}
+    for run_req, run_timeout in runs:
+        key = _get_run_request_key(run_req, run_timeout)
+        if key in prefetched or _RUN_RESULT_LRU.get(key) is not None:
+            continue
 
-        while True:
-            try:
-                connection = httplib.HTTPConnection('localhost', port)
+        common = dict(
+                (name, value) for name, value in run_req.iteritems()
+                if name != "user_code")
+        batch_key = json.dumps([common, run_timeout], sort_keys=True)
 
-                connection.request('GET', '/ping')
+        _, _, user_codes = batches.setdefault(
+                batch_key, (common, run_timeout, {}))
 
-                response = connection.getresponse()
-                response_data = response.read().decode("utf-8")
+        # Identical submissions are run once.
+        user_codes[key] = run_req.get("user_code")
 
-                if response_data != b"OK":
-                    raise InvalidPingResponse()
+    for common, run_timeout, user_codes in batches.itervalues():
+        if len(user_codes) < 2:
+            continue
 
-                break
+        keys = list(user_codes)
+        try:
+            for index, response in request_python_run_batch(
+                    common,
+                    [{"user_code": user_codes[key]} for key in keys],
+                    run_timeout):
+                prefetched[keys[index]] = response
+        except Exception:
+            # Runs that were not prefetched are requested individually.
+            pass
 
-            except socket.error as e:
-                from traceback import format_exc
-
-                if e.errno in [errno.ECONNRESET, errno.ECONNREFUSED]:
-                    if time() - start_time < docker_timeout:
-                        sleep(0.1)
-                        # and retry
-                    else:
-                        return {
-                                "result": "uncaught_error",
-                                "message": "Timeout waiting for container.",
-                                "traceback": "".join(format_exc()),
-                                }
-                else:
-                    raise
-
-            except (BadStatusLine, InvalidPingResponse):
-                if time() - start_time < docker_timeout:
-                    sleep(0.1)
-                    # and retry
-                else:
-                    return {
-                            "result": "uncaught_error",
-                            "message": "Timeout waiting for container.",
-                            "traceback": "".join(format_exc()),
-                            }
 
-        # }}}
+def clear_prefetched_python_runs():
+    _PREFETCHED_RUNS.responses = None
 
-        debug_print("PING SUCCESSFUL")
 
-        try:
-            # Add a second to accommodate 'wire' delays
-            connection = httplib.HTTPConnection('localhost', port,
-                    timeout=1 + run_timeout)
+def request_python_run(run_req, run_timeout, memoize=False):
+    """
+    :arg memoize: if *True*, a previous response to an identical request
+        may be returned instead of running the code again. Only appropriate
+        if the outcome of the run depends on nothing but the request.
+    """
+
+    from course.coderunner import get_code_runner
+    from copy import deepcopy
+
+    key = _get_run_request_key(run_req, run_timeout)
 
-            headers = {'Content-type': 'application/json'}
+    response = None
 
-            json_run_req = json.dumps(run_req).encode("utf-8")
+    prefetched = getattr(_PREFETCHED_RUNS, "responses", None)
+    if prefetched:
+        response = prefetched.get(key)
 
-            debug_print("BEFPOST")
-            connection.request('POST', '/run-python', json_run_req, headers)
-            debug_print("AFTPOST")
+    if response is None and memoize:
+        response = _RUN_RESULT_LRU.get(key)
+        if response is not None:
+            return deepcopy(response)
 
-            http_response = connection.getresponse()
-            debug_print("GETR")
-            response_data = http_response.read().decode("utf-8")
-            debug_print("READR")
-            return json.loads(response_data)
+    if response is None:
+        response = get_code_runner().run(run_req, run_timeout)
 
-        except socket.timeout:
-            return {"result": "timeout"}
+    if memoize and response.get("result") not in _UNMEMOIZABLE_RUN_RESULTS:
+        _RUN_RESULT_LRU.set(key, response)
 
-    finally:
-        if container_id is not None:
-            debug_print("-----------BEGIN DOCKER LOGS for %s" % container_id)
-            debug_print(docker_cnx.logs(container_id))
-            debug_print("-----------END DOCKER LOGS for %s" % container_id)
+    return deepcopy(response)
 
-            try:
-                docker_cnx.stop(container_id, timeout=3)
-            except DockerAPIError:
-                # That's OK--the container might have stopped on its
-                # own already.
-                pass
 
-            docker_cnx.remove_container(container_id)
+def request_python_run_batch(common, run_reqs, run_timeout):
+    """See :meth:`course.coderunner.CodeRunnerBackend.run_batch`."""
+
+    from course.coderunner import get_code_runner
+    return get_code_runner().run_batch(common, run_reqs, run_timeout)
+
+# }}}
 
 
 class PythonCodeQuestion(PageBase):
+    grading_is_expensive = True
+
     def __init__(self, vctx, location, page_desc):
         validate_struct(
                 location,
@@ -958,6 +960,7 @@ class PythonCodeQuestion(PageBase):
                     ("names_from_user", list),
                     ("test_code", str),
                     ("correct_code", str),
+                    ("deterministic", bool),
                     ],
                 )
 
@@ -996,6 +999,25 @@ class PythonCodeQuestion(PageBase):
     def answer_data(self, page_context, page_data, form):
         return {"answer": form.cleaned_data["answer"].strip()}
 
+    def make_run_request(self, answer_data):
+        """
+        :returns: a tuple *(run_req, run_timeout)* for running the code in
+            *answer_data* (which must not be *None*).
+        """
+
+        run_req = {"compile_only": False, "user_code": answer_data["answer"]}
+
+        def transfer_attr(name):
+            if hasattr(self.page_desc, name):
+                run_req[name] = getattr(self.page_desc, name)
+
+        transfer_attr("setup_code")
+        transfer_attr("names_for_user")
+        transfer_attr("names_from_user")
+        transfer_attr("test_code")
+
+        return run_req, self.page_desc.timeout
+
     def grade(self, page_context, page_data, answer_data, grade_data):
         from courseflow.utils import html_escape
 
@@ -1016,20 +1038,12 @@ class PythonCodeQuestion(PageBase):
 
         # {{{ request run
 
-        run_req = {"compile_only": False, "user_code": user_code}
-
-        def transfer_attr(name):
-            if hasattr(self.page_desc, name):
-                run_req[name] = getattr(self.page_desc, name)
-
-        transfer_attr("setup_code")
-        transfer_attr("names_for_user")
-        transfer_attr("names_from_user")
-        transfer_attr("test_code")
+        run_req, run_timeout = self.make_run_request(answer_data)
 
         try:
             response_dict = request_python_run(run_req,
-                    run_timeout=self.page_desc.timeout)
+                    run_timeout=run_timeout,
+                    memoize=getattr(self.page_desc, "deterministic", False))
         except:
             from traceback import format_exc
             response_dict = {
@@ -1,3 +1,667 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2014 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import shutil
+import tempfile
+from os.path import join, dirname, exists
+from os import makedirs
+
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+import django.core.cache as cache
+
+from course.models import Course
+from course.coderunner import CodeRunnerBackend
+
+
+COURSE_YML = """
+chunks:
+- title: Welcome
+  id: welcome
+  rules:
+  - weight: 0
+  content: |
+    # Welcome
+
+    See [the calendar](calendar:) and ![a figure](media:figure.png).
+"""
+
+
+# {{{ course repository fixture
+
+class CourseRepoTestMixin(object):
+    """Sets up a course *cs101* backed by a throwaway git repository
+    containing :attr:`course_files`.
+    """
+
+    course_files = {
+            "course.yml": COURSE_YML,
+            "events.yml": "{}\n",
+            "media/figure.png": "",
+            }
+
+    def setUp(self):
+        super(CourseRepoTestMixin, self).setUp()
+
+        self.git_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.git_root)
+
+        settings_override = override_settings(GIT_ROOT=self.git_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        clear_content_caches()
+
+        from dulwich.repo import Repo
+        self.repo = Repo.init(join(self.git_root, "cs101"), mkdir=True)
+        self.commit_sha = self.commit_files(self.course_files)
+
+        self.course = Course.objects.create(
+                identifier="cs101", email="cs101@example.com",
+                hidden=False, valid=True,
+                active_git_commit_sha=self.commit_sha)
+
+        from course.content import get_course_repos_dict
+        get_course_repos_dict().pop(self.course.pk, None)
+
+    def commit_files(self, files, message="update"):
+        for name, data in files.iteritems():
+            path = join(self.repo.path, name)
+            if not exists(dirname(path)):
+                makedirs(dirname(path))
+            with open(path, "wb") as outf:
+                outf.write(data)
+
+        self.repo.stage(list(files))
+        return self.repo.do_commit(message,
+                committer="Test <test@example.com>")
+
+
+def clear_content_caches():
+    from course import content, page
+    for lru in [
+            content._REPO_TREE_LRU,
+            content._REPO_BLOB_SHA_LRU,
+            content._CONTENT_LRU,
+            content._MARKUP_LRU,
+            content._SNAPSHOT_LRU,
+            content._RULE_EVALUATOR_LRU,
+            content._REPO_MODULE_LRU,
+            content._PAGE_INSTANCE_LRU,
+            page._RUN_RESULT_LRU,
+            ]:
+        lru.clear()
+
+    cache.caches["default"].clear()
+
+# }}}
+
+
+# {{{ shared content caches
+
+class CourseDescCacheTest(CourseRepoTestMixin, TestCase):
+    def test_rendering_leaves_cached_descriptor_unchanged(self):
+        from course.content import get_course_desc
+
+        course_desc = get_course_desc(self.repo, self.course, self.commit_sha)
+        before = repr(course_desc)
+
+        for i in range(2):
+            resp = self.client.get("/course/cs101/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertContains(resp, "/course/cs101/calendar/")
+
+        self.assertIs(
+                get_course_desc(self.repo, self.course, self.commit_sha),
+                course_desc)
+        self.assertEqual(repr(course_desc), before)
+
+# }}}
+
+
+# {{{ markup cache keys
+
+class MarkupCacheKeyTest(CourseRepoTestMixin, TestCase):
+    def test_same_commit_in_two_courses(self):
+        from course.content import get_course_repo, markup_to_html
+
+        # A copy of the repository has the same commit SHA, so only the
+        # course distinguishes the two renderings.
+        shutil.copytree(self.repo.path, join(self.git_root, "cs102"))
+        other_course = Course.objects.create(
+                identifier="cs102", email="cs102@example.com",
+                hidden=False, valid=True,
+                active_git_commit_sha=self.commit_sha)
+        other_repo = get_course_repo(other_course)
+        self.assertEqual(other_repo.head(), self.commit_sha)
+
+        text = "[the calendar](calendar:)"
+        for i in range(2):
+            self.assertIn("/course/cs101/calendar/",
+                    markup_to_html(self.course, self.repo,
+                        self.commit_sha, text))
+            self.assertIn("/course/cs102/calendar/",
+                    markup_to_html(other_course, other_repo,
+                        self.commit_sha, text))
+
+    def test_jinja_markup_of_two_commits(self):
+        from course.content import markup_to_html
+
+        first_sha = self.commit_files({"snippet.md": "first version"})
+        second_sha = self.commit_files({"snippet.md": "second version"})
+
+        text = "[JINJA]\n{% include 'snippet.md' %} ![a](media:figure.png)"
+        for i in range(2):
+            for commit_sha, version in [
+                    (first_sha, "first version"),
+                    (second_sha, "second version")]:
+                html = markup_to_html(self.course, self.repo, commit_sha, text)
+                self.assertIn(version, html)
+                self.assertIn(
+                        "/course/cs101/media/%s/figure.png" % commit_sha,
+                        html)
+
+# }}}
+
+
+# {{{ link fixing
+
+class LinkFixerTest(CourseRepoTestMixin, TestCase):
+    def test_commented_out_links_are_left_alone(self):
+        from course.content import markup_to_html
+
+        html = markup_to_html(self.course, self.repo, self.commit_sha,
+                "<div>\n"
+                "<!-- <a href=\"flow:no such flow!\">old</a> -->\n"
+                "<a href=\"flow:hw1\">new</a>\n"
+                "</div>")
+
+        self.assertIn("<!-- <a href=\"flow:no such flow!\">old</a> -->", html)
+        self.assertIn("<a href=\"/course/cs101/flow/hw1/start/\">new</a>",
+                html)
+
+# }}}
+
+
+# {{{ event index
+
+class EventIndexTest(CourseRepoTestMixin, TransactionTestCase):
+    def make_event(self, ordinal):
+        from django.utils.timezone import now
+        from course.models import Event
+        return Event.objects.create(course=self.course, kind="lecture",
+                ordinal=ordinal, time=now())
+
+    def test_version_follows_content(self):
+        from course.content import get_event_index
+
+        self.make_event(1)
+        version = get_event_index(self.course).version
+
+        cache.caches["default"].clear()
+        self.assertEqual(get_event_index(self.course).version, version)
+
+        evt = self.make_event(2)
+        self.assertNotEqual(get_event_index(self.course).version, version)
+
+        evt.delete()
+        self.assertEqual(get_event_index(self.course).version, version)
+
+    def test_invalidated_after_commit(self):
+        from django.db import transaction
+        from course.content import (
+                get_event_index, _get_event_index_cache_key, EventIndex)
+
+        stale_index = get_event_index(self.course)
+
+        with transaction.atomic():
+            self.make_event(1)
+
+            # A concurrent request caching the index from before the
+            # commit.
+            cache.caches["default"].set(
+                    _get_event_index_cache_key(self.course.pk),
+                    EventIndex(stale_index.version, stale_index.times))
+
+        self.assertIn(("lecture", 1), get_event_index(self.course).times)
+
+# }}}
+
+
+# {{{ chunk rules
+
+class RuleEvaluatorTest(TestCase):
+    def test_evaluate_returns_surrounding_changes(self):
+        from datetime import timedelta
+        from django.utils.timezone import now
+        from course.content import RuleEvaluator
+
+        t = now()
+        day = timedelta(days=1)
+        usec = timedelta(microseconds=1)
+
+        evaluator = RuleEvaluator([
+            (t+day, None, "future"),
+            (t-2*day, t-day, "past"),
+            (t-3*day, t+2*day, "current"),
+            (None, None, "default"),
+            ])
+        self.assertEqual(evaluator.evaluate(t),
+                ("current", t-day+usec, t+day))
+        self.assertEqual(evaluator.evaluate(t+3*day),
+                ("future", t+day, None))
+        self.assertEqual(evaluator.evaluate(t-4*day),
+                ("default", None, t-3*day))
+
+
+class CourseChunkCacheTest(CourseRepoTestMixin, TestCase):
+    course_files = dict(CourseRepoTestMixin.course_files, **{
+        "course.yml": COURSE_YML + """
+- title: Later
+  id: later
+  rules:
+  - start: release
+    weight: 1
+  - weight: 0
+    shown: false
+  content: Coming up
+"""})
+
+    def setUp(self):
+        super(CourseChunkCacheTest, self).setUp()
+
+        from datetime import datetime
+        from django.utils.timezone import utc
+        from course.models import Event
+
+        self.release_time = datetime(2099, 1, 1, tzinfo=utc)
+        Event.objects.create(course=self.course, kind="release",
+                time=self.release_time)
+
+    def get_chunk_ids(self, now_datetime):
+        from course.content import get_course_desc, get_processed_course_chunks
+        return [chunk.id for chunk in get_processed_course_chunks(
+            self.course, self.repo, self.commit_sha,
+            get_course_desc(self.repo, self.course, self.commit_sha),
+            "student", now_datetime)]
+
+    def test_fake_time_does_not_replace_entry(self):
+        from datetime import datetime
+        from django.utils.timezone import now, utc
+        from course.content import (
+                get_event_index, _get_course_chunks_cache_key)
+
+        def_cache = cache.caches["default"]
+        cache_key = _get_course_chunks_cache_key(self.course,
+                self.commit_sha, "student", get_event_index(self.course))
+        future = datetime(2100, 1, 1, tzinfo=utc)
+
+        self.assertEqual(self.get_chunk_ids(future), ["later", "welcome"])
+        self.assertIsNone(def_cache.get(cache_key))
+
+        self.assertEqual(self.get_chunk_ids(now()), ["welcome"])
+        valid_from, valid_until, chunks = def_cache.get(cache_key)
+        self.assertIsNone(valid_from)
+        self.assertEqual(valid_until, self.release_time)
+
+        self.assertEqual(self.get_chunk_ids(future), ["later", "welcome"])
+        self.assertEqual(self.get_chunk_ids(now()), ["welcome"])
+        self.assertEqual(def_cache.get(cache_key)[:2],
+                (valid_from, valid_until))
+
+# }}}
+
+
+# {{{ lazy page data
+
+LAZY_FLOW_YML = """
+title: Quiz
+description: A quiz
+completion_text: Done
+lazy_page_data: true
+groups:
+- id: main
+  pages:
+""" + "".join("""
+  - type: ChoiceQuestion
+    id: q%d
+    value: 1
+    title: Question %d
+    prompt: Pick one
+    shuffle: true
+    choices: ["~CORRECT~ A", "B", "C", "D", "E", "F"]
+""" % (i, i) for i in range(5))
+
+
+class LazyPageDataTest(CourseRepoTestMixin, TestCase):
+    course_files = dict(CourseRepoTestMixin.course_files, **{
+        "flows/quiz.yml": LAZY_FLOW_YML})
+
+    def start_session(self):
+        from course.models import FlowSession
+        from course.content import get_flow_desc, set_up_flow_session_page_data
+
+        flow_session = FlowSession(course=self.course, flow_id="quiz",
+                active_git_commit_sha=self.commit_sha,
+                in_progress=True, for_credit=True)
+        set_up_flow_session_page_data(self.repo, flow_session,
+                self.course.identifier,
+                get_flow_desc(self.repo, self.course, "quiz",
+                    self.commit_sha),
+                self.commit_sha)
+        return flow_session
+
+    def get_permutations(self, flow_session):
+        from course.models import FlowPageData
+        return [data.data["permutation"]
+                for data in (FlowPageData.objects
+                    .filter(flow_session=flow_session)
+                    .order_by("ordinal"))]
+
+    def test_shuffles_are_reproducible(self):
+        from course.models import FlowPageData
+        from course.content import (
+                get_flow_session_page_data, materialize_flow_session_page_data)
+
+        flow_session = self.start_session()
+        self.assertEqual(flow_session.page_count, 5)
+        self.assertEqual(
+                FlowPageData.objects.filter(flow_session=flow_session).count(),
+                0)
+
+        # one page on first visit, the rest at finish
+        get_flow_session_page_data(self.repo, self.course, flow_session, 3)
+        materialize_flow_session_page_data(
+                self.repo, self.course, flow_session)
+        permutations = self.get_permutations(flow_session)
+        self.assertEqual(len(permutations), 5)
+        self.assertNotEqual(len(set(map(tuple, permutations))), 1)
+
+        # all pages at once, in a different order
+        FlowPageData.objects.filter(flow_session=flow_session).delete()
+        materialize_flow_session_page_data(
+                self.repo, self.course, flow_session)
+        self.assertEqual(self.get_permutations(flow_session), permutations)
+
+        other_session = self.start_session()
+        materialize_flow_session_page_data(
+                self.repo, self.course, other_session)
+        self.assertNotEqual(self.get_permutations(other_session),
+                permutations)
+
+# }}}
+
+
+# {{{ deferred grading
+
+class DeferredGradingLeaseTest(CourseRepoTestMixin, TestCase):
+    def make_pending_session(self, lease_expiry):
+        from course.models import FlowSession
+        return FlowSession.objects.create(course=self.course, flow_id="quiz",
+                active_git_commit_sha=self.commit_sha,
+                in_progress=False, for_credit=True,
+                grading_pending=True, grading_lease_expiry=lease_expiry)
+
+    def test_lease_is_taken_once(self):
+        from datetime import timedelta
+        from django.utils.timezone import now
+        from course.grading import _claim_deferred_grading
+
+        flow_session = self.make_pending_session(now() - timedelta(hours=1))
+        self.assertTrue(_claim_deferred_grading(flow_session.pk))
+        self.assertFalse(_claim_deferred_grading(flow_session.pk))
+
+    def test_resume_skips_leased_sessions(self):
+        from datetime import timedelta
+        from django.utils.timezone import now
+        from course.models import FlowSession
+        from course.grading import resume_deferred_grading
+
+        flow_session = self.make_pending_session(now() + timedelta(hours=1))
+        self.assertEqual(resume_deferred_grading(), 0)
+        self.assertTrue(
+                FlowSession.objects.get(pk=flow_session.pk).grading_pending)
+
+
+class GradingJobClaimTest(CourseRepoTestMixin, TestCase):
+    def setUp(self):
+        super(GradingJobClaimTest, self).setUp()
+
+        from course.grading import enqueue_grading_jobs
+        enqueue_grading_jobs(self.make_answered_session())
+
+    def make_answered_session(self):
+        """:returns: the graded answer visits of a new finished session."""
+
+        from course.models import FlowSession, FlowPageData, FlowPageVisit
+
+        flow_session = FlowSession.objects.create(course=self.course,
+                flow_id="quiz", active_git_commit_sha=self.commit_sha,
+                in_progress=False, for_credit=True, grading_pending=True,
+                page_count=2)
+
+        visits = []
+        for ordinal in range(2):
+            page_data = FlowPageData.objects.create(
+                    flow_session=flow_session, ordinal=ordinal,
+                    group_id="main", page_id="q%d" % ordinal)
+            visits.append(FlowPageVisit.objects.create(
+                    flow_session=flow_session, page_data=page_data,
+                    answer={"choice": 0}, is_graded_answer=True))
+
+        return visits
+
+    def test_job_claimed_concurrently_is_skipped(self):
+        from course.models import GradingJob, grading_job_state
+        from course.grading import claim_grading_job
+
+        first_job, second_job = GradingJob.objects.order_by("id")
+
+        # Let another worker claim each job just before this worker's
+        # conditional update, i.e. after it has picked its candidates.
+        manager = GradingJob.objects
+        orig_filter = manager.filter
+        raced_job_ids = []
+
+        def racing_filter(*args, **kwargs):
+            if "id" in kwargs and not raced_job_ids:
+                raced_job_ids.append(kwargs["id"])
+                orig_filter(id=kwargs["id"]).update(
+                        state=grading_job_state.running, worker="other")
+            return orig_filter(*args, **kwargs)
+
+        manager.filter = racing_filter
+        try:
+            job = claim_grading_job("this")
+        finally:
+            del manager.filter
+
+        self.assertEqual(raced_job_ids, [first_job.id])
+        self.assertEqual(job.id, second_job.id)
+        self.assertEqual(job.worker, "this")
+        self.assertEqual(job.attempts, 1)
+
+        first_job = GradingJob.objects.get(id=first_job.id)
+        self.assertEqual(first_job.worker, "other")
+        self.assertEqual(first_job.attempts, 0)
+
+        self.assertIsNone(claim_grading_job("this"))
+
+    def test_jobs_for_one_question_are_claimed_together(self):
+        from course.grading import enqueue_grading_jobs, claim_grading_jobs
+
+        enqueue_grading_jobs(self.make_answered_session())
+
+        jobs = claim_grading_jobs("this")
+        self.assertEqual(
+                [job.visit.page_data.page_id for job in jobs], ["q0", "q0"])
+        self.assertEqual(
+                len(set(job.flow_session_id for job in jobs)), 2)
+
+        jobs = claim_grading_jobs("this", max_count=1)
+        self.assertEqual(
+                [job.visit.page_data.page_id for job in jobs], ["q1"])
+
+    def test_regrade(self):
+        from course.models import FlowSession, GradingJob, grading_job_state
+        from course.grading import enqueue_regrade
+
+        GradingJob.objects.update(state=grading_job_state.done)
+        FlowSession.objects.update(grading_pending=False)
+
+        with self.assertRaises(ValueError):
+            enqueue_regrade(FlowSession.objects.all())
+
+        with override_settings(CF_GRADING_QUEUE="database"):
+            jobs = enqueue_regrade(FlowSession.objects.all())
+
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(
+                GradingJob.objects
+                .filter(state=grading_job_state.queued).count(), 2)
+        self.assertTrue(FlowSession.objects.get().grading_pending)
+
+# }}}
+
+
+# {{{ code runs
+
+class FakeCodeRunner(CodeRunnerBackend):
+    def __init__(self, result="success"):
+        self.result = result
+        self.runs = []
+        self.batches = []
+
+    def run(self, run_req, run_timeout):
+        self.runs.append(run_req)
+        return {"result": self.result, "user_code": run_req["user_code"]}
+
+    def run_batch(self, common, run_reqs, run_timeout):
+        self.batches.append((common, run_reqs))
+        for index, req in enumerate(run_reqs):
+            yield index, {"result": self.result, "user_code": req["user_code"]}
+
+
+class CodeRunTest(TestCase):
+    def setUp(self):
+        import course.coderunner
+        self.code_runner = course.coderunner._CODE_RUNNER = FakeCodeRunner()
+        clear_content_caches()
+
+    def tearDown(self):
+        from course.page import clear_prefetched_python_runs
+        import course.coderunner
+        clear_prefetched_python_runs()
+        course.coderunner._CODE_RUNNER = None
+
+    def test_prefetch_batches_by_question(self):
+        from course.page import prefetch_python_runs, request_python_run
+
+        def make_run_req(question, user_code):
+            return {
+                    "setup_code": "setup_%s()" % question,
+                    "test_code": "test_%s()" % question,
+                    "user_code": user_code,
+                    }
+
+        runs = [
+                (make_run_req("a", "x = 1"), 1),
+                (make_run_req("b", "x = 1"), 1),
+                (make_run_req("a", "x = 2"), 1),
+                (make_run_req("a", "x = 1"), 1),
+                ]
+        prefetch_python_runs(runs)
+
+        # Only question "a" has several distinct answers.
+        (common, run_reqs), = self.code_runner.batches
+        self.assertEqual(common,
+                {"setup_code": "setup_a()", "test_code": "test_a()"})
+        self.assertEqual(
+                sorted(run_req["user_code"] for run_req in run_reqs),
+                ["x = 1", "x = 2"])
+
+        for run_req, run_timeout in runs:
+            response = request_python_run(run_req, run_timeout)
+            self.assertEqual(response["user_code"], run_req["user_code"])
+
+        self.assertEqual(self.code_runner.runs, [make_run_req("b", "x = 1")])
+
+    def test_memoization(self):
+        from course.page import request_python_run
+
+        run_req = {"user_code": "x = 1"}
+
+        request_python_run(run_req, 1, memoize=True)
+        request_python_run(run_req, 1, memoize=True)
+        self.assertEqual(len(self.code_runner.runs), 1)
+
+        request_python_run(run_req, 1)
+        self.assertEqual(len(self.code_runner.runs), 2)
+
+    def test_failed_runs_are_not_memoized(self):
+        from course.page import request_python_run
+
+        for result in ["timeout", "uncaught_error"]:
+            self.code_runner.result = result
+            run_req = {"user_code": result}
+
+            request_python_run(run_req, 1, memoize=True)
+            request_python_run(run_req, 1, memoize=True)
+            self.assertEqual(
+                    [req["user_code"] for req in self.code_runner.runs],
+                    [result, result])
+
+            del self.code_runner.runs[:]
+
+# }}}
+
+
+# {{{ content snapshots
+
+class CourseSnapshotTest(CourseRepoTestMixin, TestCase):
+    def test_command_compiles_snapshot_outside_repo(self):
+        from django.core.management import call_command
+        from course.content import (
+                get_course_snapshot, get_course_snapshot_path)
+
+        snapshot_dir = join(self.git_root, "snapshots")
+        with override_settings(CF_CONTENT_SNAPSHOT_DIR=snapshot_dir):
+            snapshot_path = get_course_snapshot_path(
+                    self.repo, self.commit_sha)
+            self.assertTrue(snapshot_path.startswith(snapshot_dir))
+
+            from StringIO import StringIO
+            call_command("compile_course_snapshots", stdout=StringIO())
+            self.assertTrue(exists(snapshot_path))
+
+            snapshot = get_course_snapshot(self.repo, self.commit_sha)
+            self.assertEqual(snapshot.commit_sha, self.commit_sha)
+            self.assertIn("course.yml", snapshot.yaml)
+
+# }}}
+
+# vim: foldmethod=marker
@@ -33,7 +33,8 @@ from course.views import (
         )
 from course.content import (
         get_course_repo, get_course_desc, get_flow_desc,
-        dict_to_struct, parse_date_spec, get_active_commit_sha)
+        dict_to_struct, get_flow_rule_evaluator,
+        get_active_commit_sha)
 from course.models import (
         Course,
         FlowAccessException,
@@ -46,33 +47,23 @@ from course.models import (
 # {{{ flow permissions
 
 def get_flow_permissions(course, participation, role, flow_id, flow_desc,
-        now_datetime):
+        now_datetime, commit_sha=None):
+    """
+    :arg commit_sha: the commit *flow_desc* was read from, used to cache
+        the compiled access rules.
+    """
+
     # {{{ interpret flow rules
 
-    flow_rule = None
+    evaluator = get_flow_rule_evaluator(
+            course, commit_sha, flow_id, flow_desc, role)
 
-    if not hasattr(flow_desc, "access_rules"):
+    if evaluator is None:
         flow_rule = dict_to_struct(
                 {"permissions":
                     [flow_permission.view, flow_permission.start_no_credit]})
     else:
-        for rule in flow_desc.access_rules:
-            if hasattr(rule, "roles"):
-                if role not in rule.roles:
-                    continue
-
-            if hasattr(rule, "start"):
-                start_date = parse_date_spec(course, rule.start)
-                if now_datetime < start_date:
-                    continue
-
-            if hasattr(rule, "end"):
-                end_date = parse_date_spec(course, rule.end)
-                if end_date < now_datetime:
-                    continue
-
-            flow_rule = rule
-            break
+        flow_rule, _, _ = evaluator.evaluate(now_datetime)
 
     # }}}
 
@@ -116,16 +107,10 @@ def get_flow_permissions(course, participation, role, flow_id, flow_desc,
 
 
 def instantiate_flow_page_with_ctx(fctx, page_data):
-    from course.content import get_flow_page_desc
-    page_desc = get_flow_page_desc(
-            fctx.flow_session, fctx.flow_desc, page_data.group_id, page_data.page_id)
-
-    from course.content import instantiate_flow_page
-    return instantiate_flow_page(
-            "course '%s', flow '%s', page '%s/%s'"
-            % (fctx.course_identifier, fctx.flow_identifier,
-                page_data.group_id, page_data.page_id),
-            fctx.repo, page_desc, fctx.flow_commit_sha)
+    from course.content import get_flow_page
+    return get_flow_page(fctx.repo, fctx.course_identifier,
+            fctx.flow_identifier, fctx.flow_desc,
+            page_data.group_id, page_data.page_id, fctx.flow_commit_sha)
 
 # }}}
 
@@ -195,7 +180,8 @@ class FlowContext(CoursePageContext):
         self.permissions, self.stipulations = get_flow_permissions(
                 self.course, self.participation, self.role,
                 flow_identifier, current_flow_desc,
-                get_now_or_fake_time(request))
+                get_now_or_fake_time(request),
+                commit_sha=current_flow_desc_sha)
 
         # }}}
 
@@ -224,8 +210,12 @@ class FlowPageContext(FlowContext):
                 flow_session=flow_session)
 
         from course.models import FlowPageData
-        page_data = self.page_data = get_object_or_404(
-                FlowPageData, flow_session=flow_session, ordinal=ordinal)
+        from course.content import get_flow_session_page_data
+        try:
+            page_data = self.page_data = get_flow_session_page_data(
+                    self.repo, self.course, flow_session, int(ordinal))
+        except FlowPageData.DoesNotExist:
+            raise http.Http404()
 
         from course.content import get_flow_page_desc
         self.page_desc = get_flow_page_desc(
@@ -295,47 +285,89 @@ def render_course_page(pctx, template_name, args):
     return render(pctx.request, template_name, args)
 
 
+# {{{ grading context
+
+class GradingContext(object):
+    """Resolves, once, what is needed to grade (or show) many visits to pages
+    of the flow *flow_id* at *flow_commit_sha*.
+
+    .. attribute:: flow_desc
+    .. attribute:: page_context
+
+        A :class:`course.page.PageContext`.
+    """
+
+    def __init__(self, course, repo, flow_id, flow_commit_sha):
+        self.course = course
+        self.repo = repo
+        self.flow_id = flow_id
+        self.flow_commit_sha = flow_commit_sha
+
+        self.flow_desc = get_flow_desc(repo, course, flow_id, flow_commit_sha)
+
+        from course.page import PageContext
+        self.page_context = PageContext(
+                course=course, repo=repo, commit_sha=flow_commit_sha)
+
+    def get_page(self, group_id, page_id):
+        from course.content import get_flow_page
+        return get_flow_page(self.repo, self.course.identifier, self.flow_id,
+                self.flow_desc, group_id, page_id, self.flow_commit_sha)
+
+
+def get_flow_session_grading_context(flow_session, repo=None):
+    """Return a :class:`GradingContext` for the version of the flow that
+    applies to *flow_session*.
+    """
+
+    from course.content import get_course_commit_sha, get_flow_commit_sha
+
+    course = flow_session.course
+    if repo is None:
+        repo = get_course_repo(course)
+
+    course_commit_sha = get_course_commit_sha(
+            course, flow_session.participation)
+
+    flow_desc_pre = get_flow_desc(repo, course,
+            flow_session.flow_id, course_commit_sha)
+
+    flow_commit_sha = get_flow_commit_sha(
+            course, flow_session.participation, flow_desc_pre,
+            flow_session)
+
+    return GradingContext(course, repo, flow_session.flow_id, flow_commit_sha)
+
+# }}}
+
+
 # {{{ page cache
 
 class PageInstanceCache(object):
-    """Caches instances of :class:`course.page.Page`."""
+    """Caches instances of :class:`course.page.Page`, along with a
+    :class:`GradingContext` for each commit.
+    """
 
     def __init__(self, repo, course, flow_identifier):
         self.repo = repo
         self.course = course
         self.flow_identifier = flow_identifier
-        self.flow_desc_cache = {}
-        self.page_cache = {}
+        self.grading_context_cache = {}
 
-    def get_flow_desc_from_cache(self, commit_sha):
+    def get_grading_context(self, commit_sha):
         try:
-            return self.flow_desc_cache[commit_sha]
+            return self.grading_context_cache[commit_sha]
         except KeyError:
-            flow_desc = get_flow_desc(self.repo, self.course,
+            grading_context = GradingContext(self.course, self.repo,
                     self.flow_identifier, commit_sha)
-            self.flow_desc_cache[commit_sha] = flow_desc
-            return flow_desc
-
-    def get_page(self, group_id, page_id, commit_sha):
-        key = (group_id, page_id, commit_sha)
-        try:
-            return self.page_cache[key]
-        except KeyError:
-
-            from course.content import get_flow_page_desc, instantiate_flow_page
-            page_desc = get_flow_page_desc(
-                    self.flow_identifier,
-                    self.get_flow_desc_from_cache(commit_sha),
-                    group_id, page_id)
+            self.grading_context_cache[commit_sha] = grading_context
+            return grading_context
 
-            page = instantiate_flow_page(
-                    location="flow '%s', group, '%s', page '%s'"
-                    % (self.flow_identifier, group_id, page_id),
-                    repo=self.repo, page_desc=page_desc,
-                    commit_sha=commit_sha)
+    def get_flow_desc_from_cache(self, commit_sha):
+        return self.get_grading_context(commit_sha).flow_desc
 
-            self.page_cache[key] = page
-            return page
+    def get_page(self, group_id, page_id, commit_sha):
+        return self.get_grading_context(commit_sha).get_page(group_id, page_id)
 
 # }}}
 
@@ -371,6 +371,7 @@ def validate_flow_desc(ctx, location, flow_desc):
                 ("access_rules", list),
                 ("grade_aggregation_strategy", str),
                 ("sticky_versioning", bool),
+                ("lazy_page_data", bool),
                 ]
             )
 
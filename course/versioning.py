@@ -46,6 +46,9 @@ from course.utils import course_view, render_course_page
 import paramiko
 import paramiko.client
 
+import logging
+logger = logging.getLogger(__name__)
+
 
 class AutoAcceptPolicy(paramiko.client.MissingHostKeyPolicy):
     def missing_host_key(self, client, hostname, key):
@@ -103,6 +106,49 @@ def get_dulwich_client_and_remote_path_from_course(course):
     return client, remote_path
 
 
+# {{{ content snapshots
+
+def compile_course_snapshot_logged(course, commit_sha):
+    """Compile the content snapshot of *course* at *commit_sha*, logging
+    rather than raising any error. Returns whether a snapshot was compiled.
+    """
+
+    # dulwich repositories are not thread-safe, so this uses a repository
+    # object of its own (get_course_repo keeps them per thread).
+    from course.content import get_course_repo, compile_course_snapshot
+    try:
+        compile_course_snapshot(get_course_repo(course), course, commit_sha)
+    except Exception:
+        logger.exception("content snapshot of '%s' at %s could not be "
+                "compiled, content will be served from the repository",
+                course.identifier, commit_sha)
+        return False
+
+    return True
+
+
+def start_course_snapshot_compile(course, commit_sha):
+    """Compile the content snapshot of *course* at *commit_sha* outside of
+    the current request, in a background thread. If
+    ``CF_CONTENT_SNAPSHOT_COMPILE`` is ``"command"``, this is left to the
+    ``compile_course_snapshots`` management command instead.
+    """
+
+    from django.conf import settings
+    if not getattr(settings, "CF_CONTENT_SNAPSHOTS", True):
+        return
+    if getattr(settings, "CF_CONTENT_SNAPSHOT_COMPILE", "thread") != "thread":
+        return
+
+    from threading import Thread
+    thread = Thread(target=compile_course_snapshot_logged,
+            args=(course, commit_sha))
+    thread.daemon = True
+    thread.start()
+
+# }}}
+
+
 # {{{ new course setup
 
 class CourseCreationForm(forms.ModelForm):
@@ -169,6 +215,8 @@ def set_up_new_course(request):
                         new_course.active_git_commit_sha = new_sha
                         new_course.save()
 
+                        start_course_snapshot_compile(new_course, new_sha)
+
                         # {{{ set up a participation for the course creator
 
                         part = Participation()
@@ -413,6 +461,8 @@ def update_course(pctx):
                 course.valid = True
                 course.save()
 
+                start_course_snapshot_compile(course, new_sha)
+
                 response_form = form
 
             elif validated and "preview" in form.data:
@@ -92,4 +92,76 @@ def dict_to_struct(data):
 
 # }}}
 
+
+# {{{ LRU cache
+
+class LRUCache(object):
+    """A bounded, thread-safe in-process mapping that evicts the least
+    recently used entry once more than *max_size* entries are stored.
+    A *max_size* of zero disables the cache. If *max_age* (in seconds) is
+    given, entries older than that are treated as absent.
+
+    .. attribute:: hits
+    .. attribute:: misses
+    """
+
+    def __init__(self, max_size, max_age=None):
+        from collections import OrderedDict
+        import threading
+
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (value, expiry time or None)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for *key*, or *None* if there is none."""
+
+        with self._lock:
+            try:
+                value, expiry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expiry is not None:
+                from time import time
+                if time() >= expiry:
+                    self.misses += 1
+                    return None
+
+            self._entries[key] = value, expiry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        if self.max_age is not None:
+            from time import time
+            expiry = time() + self.max_age
+        else:
+            expiry = None
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value, expiry
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+# }}}
+
 # vim: foldmethod=marker